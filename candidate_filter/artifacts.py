@@ -0,0 +1,56 @@
+import hashlib
+import json
+import os
+import pandas as pd
+import cand_cache
+
+
+# Increase when the results of a stage change for the same inputs and config
+artifact_version = 3
+
+# Config keys that change the result of a stage
+stage_config_keys = {
+    'cluster': ['max_distance_broadened_period', 'max_distance_period', 'max_distance_dm',
+                'cluster_method', 'known_sources_file',
+                'harmonic_clustering', 'max_harmonic', 'max_distance_harmonic_period',
+                'max_distance_harmonic_dm', 'max_distance_harmonic_acc'],
+    'spatial_rfi': ['min_size_cluster_for_fit', 'fit_method', 'neighbour_metric'],
+}
+
+
+def files_key(files):
+    # Hash of the input files, changes when a file is modified
+    signatures = [cand_cache.file_signature(file) for file in files]
+    return hashlib.sha1(json.dumps(signatures).encode()).hexdigest()
+
+
+def artifact_key(stage, upstream_key, config):
+    # Hash of everything the result of a stage depends on
+    # upstream_key is the key of the input files or of the previous stage
+    stage_config = {key: config.get(key) for key in stage_config_keys[stage]}
+    description = {'stage': stage,
+                   'version': artifact_version,
+                   'upstream': upstream_key,
+                   'config': stage_config}
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def cached_stage(artifact_dir, stage, upstream_key, config, compute):
+    # Load the result of a stage from artifact_dir or compute and store it
+    # Returns the result and its key, without artifact_dir the result is only computed
+    if not artifact_dir:
+        return compute(), None
+
+    key = artifact_key(stage, upstream_key, config)
+    path = os.path.join(artifact_dir, f"{stage}_{key}.pkl")
+    if os.path.exists(path):
+        print(f"Loading {stage} results from {path}.")
+        return pd.read_pickle(path), key
+
+    result = compute()
+    os.makedirs(artifact_dir, exist_ok=True)
+    # Write to a temporary file first, so that no partial artifact is loaded later
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    pd.to_pickle(result, temporary_path)
+    os.replace(temporary_path, path)
+    return result, key
@@ -0,0 +1,129 @@
+import argparse
+import contextlib
+import copy
+import glob
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+# The pipeline modules are imported once here and reused by all pointings of a worker
+import candidate_filter
+
+
+def parse_arguments():
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(
+        description='Filter the candidates of many pointings in one process pool.')
+    parser.add_argument('-m', '--manifest', type=str, required=True, metavar=('manifest_file'),
+                        help="Json list of pointings, each with 'input' and 'output'. "
+                        "'input' is a list of files or a glob pattern.")
+    parser.add_argument('-w', '--workers', type=int, default=1, metavar=('n_workers'),
+                        help="Number of pointings processed in parallel.")
+    parser.add_argument('-s', '--summary', type=str, default='', metavar=('summary_file'),
+                        help="Write the status of all pointings as json to this file.")
+    candidate_filter.add_pipeline_arguments(parser)
+    args = parser.parse_args()
+    return args
+
+
+def read_manifest(manifest_file):
+    # Returns a list of (input_files, output) for all pointings
+    with open(manifest_file) as json_file:
+        manifest = json.load(json_file)
+
+    pointings = []
+    for entry in manifest:
+        input_files = entry['input']
+        if isinstance(input_files, str):
+            input_files = sorted(glob.glob(input_files))
+        pointings.append((input_files, entry['output']))
+    return pointings
+
+
+def run_pointing_safe(args, config):
+    # Run a single pointing, errors are returned instead of raised
+    # The output of the pipeline is written to <output>_log.txt
+    start = time.perf_counter()
+    status = 'ok'
+    error = ''
+    try:
+        output_folder = os.path.dirname(args.output)
+        if output_folder:
+            os.makedirs(output_folder, exist_ok=True)
+        if len(args.input) == 0:
+            raise FileNotFoundError("No input files found.")
+        with open(f"{args.output}_log.txt", 'w') as log_file, \
+                contextlib.redirect_stdout(log_file):
+            candidate_filter.run_pointing(args, config)
+    except Exception:
+        status = 'failed'
+        error = traceback.format_exc()
+    return {'output': args.output,
+            'n_input_files': len(args.input),
+            'status': status,
+            'error': error,
+            'wall_time': time.perf_counter() - start}
+
+
+def run_batch(pointing_args, config, n_workers=1):
+    # Process all pointings in one pool, a failing pointing does not stop the others
+    # Returns one result per pointing in the order of pointing_args
+    results = [None] * len(pointing_args)
+    broken = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(run_pointing_safe, single_args, config): index
+                   for index, single_args in enumerate(pointing_args)}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                results[index] = future.result()
+            except BrokenProcessPool:
+                broken.append(index)
+                continue
+            print(f"{results[index]['status']}: {results[index]['output']}")
+
+    # A dying worker breaks the whole pool, the affected pointings are run again
+    # one by one, so that only the pointing which kills its worker fails
+    for index in sorted(broken):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            try:
+                results[index] = executor.submit(
+                    run_pointing_safe, pointing_args[index], config).result()
+            except BrokenProcessPool:
+                results[index] = {'output': pointing_args[index].output,
+                                  'n_input_files': len(pointing_args[index].input),
+                                  'status': 'failed',
+                                  'error': "Worker process died.",
+                                  'wall_time': None}
+        print(f"{results[index]['status']}: {results[index]['output']}")
+    return results
+
+
+def main(args):
+    with open(args.config) as json_data_file:
+        config = json.load(json_data_file)
+
+    pointing_args = []
+    for input_files, output in read_manifest(args.manifest):
+        single_args = copy.copy(args)
+        single_args.input = input_files
+        single_args.output = output
+        pointing_args.append(single_args)
+
+    results = run_batch(pointing_args, config, n_workers=args.workers)
+
+    n_failed = sum(result['status'] != 'ok' for result in results)
+    print(f"{len(results) - n_failed} pointings processed, {n_failed} failed.")
+    if args.summary:
+        with open(args.summary, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+    return n_failed
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    n_failed = main(args)
+    sys.exit(1 if n_failed else 0)
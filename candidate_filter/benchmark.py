@@ -0,0 +1,193 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import reading_cands
+import cluster_cands
+import spatial_rfi
+import filtering
+import writing_cands
+import synthetic_cands
+
+
+def parse_arguments():
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(
+        description='Time the stages of the candidate filtering on synthetic pointings.')
+    parser.add_argument('-w', '--workdir', type=str, required=True, metavar=('workdir'),
+                        help="Folder for the synthetic pointings and the outputs.")
+    parser.add_argument('-s', '--sizes', type=int, default=[1000, 10000, 100000], nargs='+',
+                        help="Number of candidates of the benchmarked pointings.")
+    parser.add_argument('-b', '--beams', type=int, default=100,
+                        help="Number of beams of the synthetic pointings.")
+    default_config_path = f"{os.path.dirname(__file__)}/default_config.json"
+    parser.add_argument('-c', '--config', type=str, default=default_config_path,
+                        metavar=('config_file'), help="Path to config file.")
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar=('n_jobs'),
+                        help="Number of processes used by the stages.")
+    parser.add_argument('-m', '--memory', action='store_true',
+                        help="Trace the peak memory of each stage. Slows down the stages.")
+    parser.add_argument('--check-reference', type=int, default=0, metavar=('max_size'),
+                        help="Compare the clusters with cluster_cand_df_reference up to this size.")
+    parser.add_argument('--check-methods', action='store_true',
+                        help="Compare the clusters of all cluster_methods with the sweep.")
+    parser.add_argument('-o', '--output', type=str, default='', metavar=('report_file'),
+                        help="Write the results as json to this file.")
+    args = parser.parse_args()
+    return args
+
+
+def measure(function, *args, trace_memory=False, **kwargs):
+    # Run a stage, returns the result, the wall time and the traced peak memory in MB
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    wall_time = time.perf_counter() - start
+    if trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        tracemalloc.stop()
+    else:
+        peak_memory = np.nan
+    return result, wall_time, peak_memory
+
+
+def max_rss():
+    # Peak resident memory of the process in MB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def cluster_hash(df_cands):
+    # Hash of the cluster assignment, identical output gives an identical hash
+    cluster_ids = df_cands['cluster_id'].to_numpy(dtype=np.int64)
+    return hashlib.sha1(cluster_ids.tobytes()).hexdigest()
+
+
+def benchmark_size(n_candidates, args, config):
+    # Create a pointing with n_candidates and time all stages of the filtering
+    pointing_folder = os.path.join(args.workdir, f"pointing_{args.beams}_{n_candidates}")
+    files = [os.path.join(pointing_folder, f"beam_{beam_index:04d}", 'overview.xml')
+             for beam_index in range(args.beams)]
+    if not all(os.path.exists(file) for file in files):
+        files, _ = synthetic_cands.generate_pointing(pointing_folder, n_beams=args.beams,
+                                                     n_candidates=n_candidates)
+    output_folder = os.path.join(pointing_folder, 'single_beams')
+
+    rows = []
+
+    def add_row(stage, rows_in, rows_out, wall_time, peak_memory):
+        rows.append({'candidates': n_candidates,
+                     'stage': stage,
+                     'rows_in': rows_in,
+                     'rows_out': rows_out,
+                     'wall_time': wall_time,
+                     # Candidates per second
+                     'throughput': n_candidates / wall_time if wall_time > 0 else np.nan,
+                     'peak_memory_mb': peak_memory,
+                     'max_rss_mb': max_rss()})
+
+    (df_cands, df_beams, obs_meta_data), wall_time, peak_memory = measure(
+        reading_cands.read_candidate_files, files, verbose=False, n_jobs=args.jobs,
+        trace_memory=args.memory)
+    add_row('read', len(files), len(df_cands), wall_time, peak_memory)
+    df_read = df_cands.copy()
+
+    df_cands, wall_time, peak_memory = measure(
+        cluster_cands.cluster_cand_df, df_cands, obs_meta_data, config,
+        trace_memory=args.memory)
+    add_row('cluster', len(df_cands), df_cands['cluster_id'].nunique(), wall_time, peak_memory)
+
+    df_clusters, wall_time, peak_memory = measure(
+        spatial_rfi.label_spatial_rfi, df_cands, df_beams, config, n_jobs=args.jobs,
+        trace_memory=args.memory)
+    add_row('spatial_rfi', len(df_clusters), len(df_clusters), wall_time, peak_memory)
+
+    # filter_clusters prints a summary, which is not needed here
+    with contextlib.redirect_stdout(io.StringIO()):
+        (df_cands, df_clusters), wall_time, peak_memory = measure(
+            filtering.filter_clusters, df_cands, df_clusters, config,
+            trace_memory=args.memory)
+    add_row('filter', len(df_cands), len(df_cands), wall_time, peak_memory)
+
+    _, wall_time, peak_memory = measure(
+        writing_cands.write_single_beams, reading_cands.join_beam_columns(df_cands, df_beams),
+        output_folder, n_jobs=args.jobs,
+        trace_memory=args.memory)
+    add_row('write', len(df_cands), df_cands['file_index'].nunique(), wall_time, peak_memory)
+
+    result = {'candidates': n_candidates,
+              'cluster_hash': cluster_hash(df_cands),
+              'reference_identical': None,
+              'methods': {}}
+    if n_candidates <= args.check_reference:
+        df_reference = cluster_cands.cluster_cand_df_reference(
+            df_read.copy(), obs_meta_data, config)
+        result['reference_identical'] = identical_clusters(df_reference, df_cands)
+    if args.check_methods:
+        # 'sweep' is the first method and the one all others are compared with
+        for method in cluster_cands.cluster_methods:
+            df_method, wall_time, _ = measure(
+                cluster_cands.cluster_cand_df, df_read.copy(), obs_meta_data,
+                dict(config, cluster_method=method))
+            if method == 'sweep':
+                df_sweep = df_method
+            result['methods'][method] = {'wall_time': wall_time,
+                                         'identical_to_sweep': identical_clusters(df_sweep, df_method)}
+    return rows, result
+
+
+def identical_clusters(df_cands_1, df_cands_2):
+    # Same cluster assignment and strongest candidates
+    return bool(
+        (df_cands_1['cluster_id'].values == df_cands_2['cluster_id'].values).all() and
+        (df_cands_1['strongest_in_cluster'].values == df_cands_2['strongest_in_cluster'].values).all())
+
+
+def main(args):
+    # Returns 1 when the clusters of a checked method or of the reference differ, otherwise 0
+    with open(args.config) as json_data_file:
+        config = json.load(json_data_file)
+
+    all_rows = []
+    results = []
+    for n_candidates in args.sizes:
+        rows, result = benchmark_size(n_candidates, args, config)
+        all_rows.extend(rows)
+        results.append(result)
+
+        print(pd.DataFrame(rows).to_string(index=False))
+        print(f"Cluster hash: {result['cluster_hash']}")
+        if result['reference_identical'] is not None:
+            print(f"Identical to reference: {result['reference_identical']}")
+        for method, method_result in result['methods'].items():
+            print(f"cluster_method {method}: {method_result['wall_time']:.3f} s, "
+                  f"identical to sweep: {method_result['identical_to_sweep']}")
+        print()
+
+    if args.output:
+        with open(args.output, 'w') as json_file:
+            json.dump({'config': config, 'stages': all_rows, 'results': results},
+                      json_file, indent=2)
+
+    # Differing clusters fail the run, so the checks can be used in regression runs
+    identical = [result['reference_identical'] for result in results
+                 if result['reference_identical'] is not None]
+    identical += [method_result['identical_to_sweep'] for result in results
+                  for method_result in result['methods'].values()]
+    if not all(identical):
+        print("Clusters differ from the sweep or the reference.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    sys.exit(main(args))
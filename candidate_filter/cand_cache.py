@@ -0,0 +1,72 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+
+# Increase when the cached format or the parsing changes
+cache_version = 3
+
+cache_modes = ['off', 'use', 'rebuild']
+
+
+def beam_cache_path(cache_dir, file):
+    # Each beam is stored in a folder named after the hash of its absolute path
+    key = hashlib.sha1(os.path.abspath(file).encode()).hexdigest()
+    return os.path.join(cache_dir, key)
+
+
+def file_signature(file):
+    # Values that invalidate the cache of a beam when they change
+    stat = os.stat(file)
+    return {"file": os.path.abspath(file),
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "version": cache_version}
+
+
+def load_beam(cache_dir, file):
+    # Load the columns and header of a beam from the cache
+    # Returns None if the beam is not cached or the cache is outdated
+    path = beam_cache_path(cache_dir, file)
+    try:
+        with open(os.path.join(path, 'meta.json')) as json_file:
+            meta = json.load(json_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    if meta['signature'] != file_signature(file):
+        return None
+
+    columns = {}
+    for column_index, (name, dtype) in enumerate(meta['columns']):
+        column_file = os.path.join(path, f"{column_index}.npy")
+        # Object arrays can not be memory mapped
+        if dtype == 'object':
+            columns[name] = np.load(column_file, allow_pickle=True)
+        else:
+            columns[name] = np.load(column_file, mmap_mode='r')
+    return columns, meta['header']
+
+
+def save_beam(cache_dir, file, columns, header):
+    # Write the columns and header of a beam into the cache
+    path = beam_cache_path(cache_dir, file)
+    os.makedirs(path, exist_ok=True)
+
+    # meta.json is written last, so partially written beams are never loaded
+    meta_file = os.path.join(path, 'meta.json')
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+
+    column_info = []
+    for column_index, (name, values) in enumerate(columns.items()):
+        np.save(os.path.join(path, f"{column_index}.npy"), values)
+        column_info.append([name, str(values.dtype)])
+
+    meta = {"signature": file_signature(file),
+            "columns": column_info,
+            "header": header}
+    with open(meta_file, 'w') as json_file:
+        json.dump(meta, json_file)
+
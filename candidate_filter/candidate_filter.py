@@ -1,10 +1,17 @@
 import argparse
 import json
 import os
+import artifacts
+import cand_cache
+import instrumentation
 import reading_cands
 import cluster_cands
+import harmonics
+import known_sources
+import out_of_core
 import spatial_rfi
 import filtering
+import writing_cands
 
 
 def parse_arguments():
@@ -15,13 +22,43 @@ def parse_arguments():
                         help="Path to the input files.", nargs='+')
     parser.add_argument('-o', '--output', type=str, default='', metavar=('output_path'),
                         help="Base name of the output csv files")
+    add_pipeline_arguments(parser)
+    args = parser.parse_args()
+    return args
+
+
+def add_pipeline_arguments(parser):
+    # Arguments shared with the batch processing of many pointings
     default_config_path = f"{os.path.dirname(__file__)}/default_config.json"
     parser.add_argument('-c', '--config', type=str, default=default_config_path,
                         metavar=('config_file'), help="Path to config file.")
     parser.add_argument('-p', '--plot', action='store_true',
                         help="Plot diagnostic plots of the clusters.")
-    args = parser.parse_args()
-    return args
+    parser.add_argument('--plot-top', type=int, default=None, metavar=('n_clusters'),
+                        help="Only plot the largest n_clusters fitted clusters.")
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar=('n_jobs'),
+                        help="Number of processes used for reading, fitting and writing.")
+    parser.add_argument('--beam-format', type=str, default=['csv'], nargs='+',
+                        choices=writing_cands.output_formats,
+                        help="File formats of the candidate lists of single beams.")
+    parser.add_argument('--cache', type=str, default='off', choices=cand_cache.cache_modes,
+                        help="Use, rebuild or bypass the cache of parsed input files.")
+    parser.add_argument('--cache-dir', type=str, default='', metavar=('cache_dir'),
+                        help="Folder of the cache. Defaults to candidate_cache/ next to the output.")
+    parser.add_argument('--profile-stage', type=str, default=None,
+                        choices=instrumentation.stage_names,
+                        help="Run this stage under cProfile and write <output>_<stage>.prof.")
+    parser.add_argument('--artifacts', type=str, default='', metavar=('artifact_dir'),
+                        help="Store the clustered candidates and the cluster list in this folder "
+                        "and reuse them when only later stages are affected by the config.")
+    parser.add_argument('--known-sources', type=str, default='', metavar=('known_sources_file'),
+                        help="Csv or json file of known periods which are tagged or removed "
+                        "before the clustering. Overrides known_sources_file of the config.")
+    parser.add_argument('--out-of-core', action='store_true',
+                        help="Cluster the candidates in period bands which are kept on disk, "
+                        "for pointings which do not fit into memory.")
+    parser.add_argument('--band-rows', type=int, default=1000000, metavar=('n_candidates'),
+                        help="Number of candidates per period band in the out-of-core mode.")
 
 
 def main(args):
@@ -31,40 +68,120 @@ def main(args):
     with open(args.config) as json_data_file:
         config = json.load(json_data_file)
 
-    # Read files into a single pandas DataFrame
-    df_cands_ini, obs_meta_data = reading_cands.read_candidate_files(
-        args.input)
+    run_pointing(args, config)
 
-    # Create clusters
-    df_cands_clustered = cluster_cands.cluster_cand_df(
-        df_cands_ini, obs_meta_data, config)
+
+def run_pointing(args, config):
+    # Filter the candidates of a single pointing given by args.input and args.output
+
+    # Check the output formats before doing any work
+    writing_cands.check_output_formats(args.beam_format)
+    if args.known_sources:
+        config = dict(config, known_sources_file=args.known_sources)
+
+    # Measure the stages, the report is written next to the output csv files
+    profile_path = f"{args.output}_{args.profile_stage}.prof"
+    report = instrumentation.RunReport(profile_stage=args.profile_stage,
+                                       profile_path=profile_path)
+
+    if args.out_of_core:
+        out_of_core.run_out_of_core(args, config, report, band_rows=args.band_rows)
+        report.write(f"{args.output}_report.json", config=config, n_input_files=len(args.input),
+                     n_jobs=args.jobs, out_of_core=True)
+        return
+
+    # Results of the expensive stages are reused from the artifact folder
+    # when the input files and the config keys they depend on are unchanged
+    # The known source file is an input like the candidate files
+    input_files = list(args.input)
+    if config.get('known_sources_file'):
+        input_files.append(config['known_sources_file'])
+    inputs_key = artifacts.files_key(input_files) if args.artifacts else None
+    (df_cands_clustered, df_beams, obs_meta_data, df_known), cluster_key = artifacts.cached_stage(
+        args.artifacts, 'cluster', inputs_key, config,
+        lambda: read_and_cluster(args, config, report))
 
     # Find spatial RFI and write out details about clusters
-    plot_arguments = [args.plot, f"{os.path.dirname(args.output)}/cluster_plots/"]
-    df_clusters = spatial_rfi.label_spatial_rfi(df_cands_clustered, config, 
-        plot_arguments=plot_arguments)
+    df_clusters, _ = artifacts.cached_stage(
+        args.artifacts, 'spatial_rfi', cluster_key, config,
+        lambda: find_spatial_rfi(df_cands_clustered, df_beams, config, args, report))
 
     # Label bad clusters
-    df_cands_filtered, df_clusters_filtered = filtering.filter_clusters(df_cands_clustered,
-                                                                        df_clusters, config)
-
-    # Write out candidate list
-    df_cands_filtered.to_csv(f"{args.output}_cands.csv")
-    # Write out cluster list
-    df_clusters_filtered.to_csv(f"{args.output}_clusters.csv")
-
-    # Write out candidate lists for single beams
-    output_folder = f"{os.path.dirname(args.output)}/single_beams/"
-    try:
-        os.mkdir(output_folder)
-    except FileExistsError:
-        pass
-    unique_file_idxs = df_cands_filtered['file_index']
-    for file_index in unique_file_idxs:
-        df_file = df_cands_filtered[df_cands_filtered['file_index'] == file_index]
-        file_name = os.path.basename(os.path.dirname(df_file['file'].iloc[0]))
-        df_file.to_csv(f"{output_folder}{file_name}.csv")
+    with report.stage('filter', rows_in=len(df_clusters)) as stage:
+        df_cands_filtered, df_clusters_filtered = filtering.filter_clusters(df_cands_clustered,
+                                                                            df_clusters, config)
+        # Clusters which are not labelled by any filter
+        stage['rows_out'] = int((~df_clusters_filtered[list(filtering.filter_rules)].any(axis=1)).sum())
+
+    with report.stage('write', rows_in=len(df_cands_filtered)) as stage:
+        # The output files contain the beam positions of the candidates
+        df_cands_output = reading_cands.join_beam_columns(df_cands_filtered, df_beams)
+        # Write out candidate list
+        df_cands_output.to_csv(f"{args.output}_cands.csv")
+        # Write out cluster list
+        df_clusters_filtered.to_csv(f"{args.output}_clusters.csv")
+        # Write out the candidates removed as known sources
+        if df_known is not None:
+            reading_cands.join_beam_columns(df_known, df_beams).to_csv(
+                f"{args.output}_known_sources.csv")
+
+        # Write out candidate lists for single beams
+        output_folder = f"{os.path.dirname(args.output)}/single_beams/"
+        writing_cands.write_single_beams(df_cands_output, output_folder,
+                                         formats=args.beam_format, n_jobs=args.jobs)
+        stage['rows_out'] = int(df_cands_filtered['file_index'].nunique())
+
+    # Plot diagnostic plots after all results are written
+    if args.plot:
+        with report.stage('plot', rows_in=len(df_clusters_filtered)):
+            # Imported here, so matplotlib is only loaded when plotting
+            import plotting
+            plotting.plot_clusters(df_clusters_filtered, df_cands_filtered, df_beams,
+                                   f"{os.path.dirname(args.output)}/cluster_plots/",
+                                   n_jobs=args.jobs, top_n=args.plot_top)
+
+    report.write(f"{args.output}_report.json", config=config, n_input_files=len(args.input),
+                 n_jobs=args.jobs)
+
+
+def read_and_cluster(args, config, report):
+    # Read files into a single pandas DataFrame
+    cache_dir = args.cache_dir or os.path.join(os.path.dirname(args.output), 'candidate_cache')
+    with report.stage('read', rows_in=len(args.input)) as stage:
+        df_cands_ini, df_beams, obs_meta_data = reading_cands.read_candidate_files(
+            args.input, n_jobs=args.jobs, cache_dir=cache_dir, cache_mode=args.cache)
+        stage['rows_out'] = len(df_cands_ini)
+
+    # Tag known sources and remove the ones which should not be clustered
+    df_known = None
+    if config.get('known_sources_file'):
+        with report.stage('known_sources', rows_in=len(df_cands_ini)) as stage:
+            df_cands_ini, df_known = known_sources.apply_known_sources(
+                df_cands_ini, config['known_sources_file'])
+            stage['rows_out'] = len(df_cands_ini)
+
+    # Create clusters
+    with report.stage('cluster', rows_in=len(df_cands_ini)) as stage:
+        df_cands_clustered = cluster_cands.cluster_cand_df(
+            df_cands_ini, obs_meta_data, config)
+        stage['rows_out'] = int(df_cands_clustered['cluster_id'].nunique())
+
+    # Merge clusters of harmonically related candidates
+    if config.get('harmonic_clustering', False):
+        with report.stage('harmonics', rows_in=stage['rows_out']) as stage:
+            df_cands_clustered = harmonics.associate_harmonics(
+                df_cands_clustered, obs_meta_data, config)
+            stage['rows_out'] = int(df_cands_clustered['cluster_id'].nunique())
+    return df_cands_clustered, df_beams, obs_meta_data, df_known
+
 
+def find_spatial_rfi(df_cands_clustered, df_beams, config, args, report):
+    # Find spatial RFI and collect details about clusters
+    with report.stage('spatial_rfi', rows_in=len(df_cands_clustered)) as stage:
+        df_clusters = spatial_rfi.label_spatial_rfi(df_cands_clustered, df_beams, config,
+                                                    n_jobs=args.jobs)
+        stage['rows_out'] = len(df_clusters)
+    return df_clusters
 
 if __name__ == "__main__":
     args = parse_arguments()
@@ -1,5 +1,10 @@
+import warnings
 import pandas as pd
 import numpy as np
+from scipy.spatial import cKDTree
+
+
+cluster_methods = ['sweep', 'tree', 'numba']
 
 
 def compare_periods(cand_1, cand_2, obs_length):
@@ -57,8 +62,247 @@ def relate_candidates(cand_1, cand_2, obs_meta_data, config):
     return related
 
 
+def broadened_distance_arrays(period_1, period_2, acc_1, acc_2, obs_meta_data):
+    # Array version of broadened_distance, period_1 should be the lower period
+    delta_abs_acc = np.abs(acc_2 - acc_1)
+    period_1_broadened = acc_upper_range(
+        period_1, delta_abs_acc, obs_meta_data["obs_length_over_c"])
+    distance = obs_meta_data["obs_length"] / \
+        period_1_broadened - obs_meta_data["obs_length"] / period_2
+    return np.where(period_2 > period_1_broadened, distance, 0)
+
+
+def relate_candidates_arrays(period_1, period_2, dm_1, dm_2, acc_1, acc_2,
+                             obs_meta_data, config):
+    # Array version of relate_candidates, returns a boolean mask
+    dm_distance = np.abs(dm_2 - dm_1)
+    rot_distance = broadened_distance_arrays(
+        period_1, period_2, acc_1, acc_2, obs_meta_data)
+    return (dm_distance < config['max_distance_dm']) & \
+        (rot_distance < config['max_distance_broadened_period'])
+
+
+def period_window_bounds(rotations, max_distance_period):
+    # Approximate window bounds for every candidate in the period sorted arrays
+    # rotations is obs_length / period and therefore non-increasing
+    # upper: first index with rotations[i] - rotations[j] > max_distance_period
+    # lower: first index with rotations[j] - rotations[i] <= max_distance_period
+    negative_rotations = -rotations
+    upper = np.searchsorted(negative_rotations,
+                            max_distance_period - rotations, side='right')
+    lower = np.searchsorted(negative_rotations,
+                            -(rotations + max_distance_period), side='left')
+    return lower, upper
+
+
+def exact_bound(too_far, bound, start, stop):
+    # Move an approximate bound to the first index in [start, stop] where the
+    # monotonic predicate too_far becomes True, so that rounding in the
+    # searchsorted values can not change the result
+    while bound > start and too_far(bound - 1):
+        bound -= 1
+    while bound < stop and not too_far(bound):
+        bound += 1
+    return bound
+
+
+def cluster_cand_arrays(period, dm, acc, obs_meta_data, config, chunk_size=64):
+    # Cluster candidates given as arrays which are sorted by snr
+    # Gives the same result as cluster_cand_df_reference, but evaluates all
+    # candidates inside the period window of a new cluster at once
+
+    max_distance_period = config['max_distance_period']
+    obs_length = obs_meta_data["obs_length"]
+    n_cands = len(period)
+
+    # Same ordering as sort_values('period') in the reference implementation
+    period_order = np.argsort(period, kind='quicksort')
+    period_position = np.empty(n_cands, dtype=np.intp)
+    period_position[period_order] = np.arange(n_cands)
+
+    period_sorted = period[period_order]
+    dm_sorted = dm[period_order]
+    acc_sorted = acc[period_order]
+    rotations = obs_length / period_sorted
+    lower, upper = period_window_bounds(rotations, max_distance_period)
+
+    cluster_sorted = np.full(n_cands, -1, dtype=np.int64)
+    strongest = np.zeros(n_cands, dtype=bool)
+
+    cluster_id = 0
+    # Cycle through all candidates (sorted by snr)
+    for snr_index in range(n_cands):
+        base = period_position[snr_index]
+
+        # Disregard candidates already in cluster
+        if cluster_sorted[base] >= 0:
+            continue
+
+        # Create a new cluster
+        cluster_sorted[base] = cluster_id
+        strongest[snr_index] = True
+
+        base_period = period_sorted[base]
+        base_dm = dm_sorted[base]
+        base_acc = acc_sorted[base]
+        base_rotations = rotations[base]
+
+        def related_above(indices):
+            return relate_candidates_arrays(
+                base_period, period_sorted[indices], base_dm, dm_sorted[indices],
+                base_acc, acc_sorted[indices], obs_meta_data, config)
+
+        def related_below(indices):
+            return relate_candidates_arrays(
+                period_sorted[indices], base_period, dm_sorted[indices], base_dm,
+                acc_sorted[indices], base_acc, obs_meta_data, config)
+
+        # Periods higher than the base_period
+        stop = exact_bound(
+            lambda j: abs(base_rotations - rotations[j]) > max_distance_period,
+            upper[base], base + 1, n_cands)
+        indices = base + 1 + \
+            np.flatnonzero(cluster_sorted[base + 1:stop] < 0)
+        cluster_sorted[indices[related_above(indices)]] = cluster_id
+        # Beyond the window the loop breaks at the first unrelated candidate
+        while stop < n_cands:
+            next_stop = min(stop + chunk_size, n_cands)
+            indices = stop + \
+                np.flatnonzero(cluster_sorted[stop:next_stop] < 0)
+            if assign_until_break(cluster_sorted, indices,
+                                  related_above(indices), cluster_id):
+                break
+            stop = next_stop
+
+        # Periods lower than the base_period
+        start = exact_bound(
+            lambda j: abs(base_rotations - rotations[j]) <= max_distance_period,
+            lower[base], 0, base)
+        indices = start + np.flatnonzero(cluster_sorted[start:base] < 0)
+        cluster_sorted[indices[related_below(indices)]] = cluster_id
+        while start > 0:
+            next_start = max(start - chunk_size, 0)
+            indices = next_start + \
+                np.flatnonzero(cluster_sorted[next_start:start] < 0)
+            indices = indices[::-1]
+            if assign_until_break(cluster_sorted, indices,
+                                  related_below(indices), cluster_id):
+                break
+            start = next_start
+
+        cluster_id += 1
+
+    return cluster_sorted[period_position], strongest
+
+
+def assign_until_break(cluster_sorted, indices, related, cluster_id):
+    # Assign related candidates up to the first unrelated one
+    # Returns True if an unrelated candidate was found
+    unrelated = np.flatnonzero(~related)
+    if len(unrelated):
+        cluster_sorted[indices[:unrelated[0]]] = cluster_id
+        return True
+    cluster_sorted[indices] = cluster_id
+    return False
+
+
+def cluster_cand_arrays_tree(period, dm, acc, obs_meta_data, config):
+    # Cluster candidates given as arrays which are sorted by snr
+    # The neighbours of a new cluster are found with a range query in a KD-tree over
+    # (rotations / max_distance_period, dm / max_distance_dm), so candidates with a
+    # similar period but a different dm are never compared
+    # acc is not part of the tree, a larger acc difference broadens the period more
+    # and can only make candidates more related, so it can not be used for pruning
+    # Unlike cluster_cand_arrays, candidates outside the period window are not added,
+    # which only happens for chains of strongly broadened candidates
+
+    max_distance_period = config['max_distance_period']
+    max_distance_dm = config['max_distance_dm']
+    obs_length = obs_meta_data["obs_length"]
+    n_cands = len(period)
+
+    rotations = obs_length / period
+    tree = cKDTree(np.column_stack([rotations / max_distance_period, dm / max_distance_dm]))
+
+    cluster_ids = np.full(n_cands, -1, dtype=np.int64)
+    strongest = np.zeros(n_cands, dtype=bool)
+
+    cluster_id = 0
+    # Cycle through all candidates (sorted by snr)
+    for base in range(n_cands):
+        # Disregard candidates already in cluster
+        if cluster_ids[base] >= 0:
+            continue
+
+        # Create a new cluster
+        cluster_ids[base] = cluster_id
+        strongest[base] = True
+
+        # Chebyshev distance, the small margin is removed by the exact tests below
+        neighbours = np.asarray(tree.query_ball_point(
+            tree.data[base], r=1 + 1e-9, p=np.inf), dtype=np.intp)
+        neighbours = neighbours[(cluster_ids[neighbours] < 0) &
+                                (np.abs(rotations[neighbours] - rotations[base]) <= max_distance_period)]
+
+        # relate_candidates_arrays needs the lower period first
+        higher = period[neighbours] >= period[base]
+        related = np.where(
+            higher,
+            relate_candidates_arrays(period[base], period[neighbours], dm[base], dm[neighbours],
+                                     acc[base], acc[neighbours], obs_meta_data, config),
+            relate_candidates_arrays(period[neighbours], period[base], dm[neighbours], dm[base],
+                                     acc[neighbours], acc[base], obs_meta_data, config))
+        cluster_ids[neighbours[related]] = cluster_id
+
+        cluster_id += 1
+
+    return cluster_ids, strongest
+
+
+def cluster_function(method):
+    # Function clustering the snr sorted period, dm and acc arrays for a cluster_method
+    if method not in cluster_methods:
+        raise ValueError(f"Unknown cluster_method {method}, options are {cluster_methods}")
+    if method == 'tree':
+        return cluster_cand_arrays_tree
+    if method == 'numba':
+        # The compiled kernel is optional, without numba the sweep gives the same result
+        try:
+            import cluster_kernel
+        except ImportError:
+            warnings.warn("numba is not installed, cluster_method sweep is used instead of numba.")
+            return cluster_cand_arrays
+        return cluster_kernel.cluster_cand_arrays_numba
+    return cluster_cand_arrays
+
+
 def cluster_cand_df(df_cands, obs_meta_data, config):
     # Cluster candidates without harmonics
+    # df_cands needs to be sorted by snr
+
+    # max_distance_broadened_period defines how close related candidates should be after
+    # broadening in rotations
+    # max_distance_period defines how close the periods should be in order
+    # for the broadening to be calculated
+    # RFI signals can show a broad DM signature, which might require a two-step clustering
+    # cluster_method 'tree' finds the neighbours with a KD-tree instead of the period sweep,
+    # 'numba' runs the candidate-by-candidate loop compiled
+    cluster_arrays = cluster_function(config.get('cluster_method', 'sweep'))
+    cluster_ids, strongest = cluster_arrays(
+        df_cands['period'].to_numpy(dtype=float),
+        df_cands['dm'].to_numpy(dtype=float),
+        df_cands['acc'].to_numpy(dtype=float),
+        obs_meta_data, config)
+
+    df_cands['cluster_id'] = cluster_ids
+    df_cands['strongest_in_cluster'] = strongest.astype(int)
+    return df_cands
+
+
+def cluster_cand_df_reference(df_cands, obs_meta_data, config):
+    # Cluster candidates without harmonics
+    # Original candidate-by-candidate implementation, kept as reference for
+    # the array based engine in cluster_cand_df
 
     # max_distance_broadened_period defines how close related candidates should be after
     # broadening in rotations
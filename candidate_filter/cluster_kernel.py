@@ -0,0 +1,94 @@
+import numpy as np
+from numba import njit
+
+
+# Compiled version of the candidate-by-candidate clustering in cluster_cand_df_reference
+# Requires numba, cluster_cands falls back to the NumPy implementation without it
+
+
+@njit(cache=True)
+def relate_kernel(period_1, period_2, dm_1, dm_2, acc_1, acc_2,
+                  obs_length, obs_length_over_c, max_distance_dm, max_distance_broadened_period):
+    # Same test as relate_candidates, period_1 should be the lower period
+    if not abs(dm_2 - dm_1) < max_distance_dm:
+        return False
+    period_1_broadened = period_1 / (1 - abs(acc_2 - acc_1) * obs_length_over_c)
+    if period_2 > period_1_broadened:
+        rot_distance = obs_length / period_1_broadened - obs_length / period_2
+    else:
+        rot_distance = 0.
+    return rot_distance < max_distance_broadened_period
+
+
+@njit(cache=True)
+def cluster_sorted_kernel(period_sorted, dm_sorted, acc_sorted, period_position,
+                          obs_length, obs_length_over_c, max_distance_period,
+                          max_distance_dm, max_distance_broadened_period):
+    # Cluster candidates given as period sorted arrays
+    # period_position gives the position in the sorted arrays of the candidates in snr order
+    n_cands = len(period_sorted)
+    cluster_sorted = np.full(n_cands, -1, dtype=np.int64)
+    strongest = np.zeros(n_cands, dtype=np.bool_)
+
+    cluster_id = 0
+    # Cycle through all candidates (sorted by snr)
+    for snr_index in range(n_cands):
+        base = period_position[snr_index]
+
+        # Disregard candidates already in cluster
+        if cluster_sorted[base] >= 0:
+            continue
+
+        # Create a new cluster
+        cluster_sorted[base] = cluster_id
+        strongest[snr_index] = True
+        base_rotations = obs_length / period_sorted[base]
+
+        # Cycle through the periods higher than the base_period
+        for index in range(base + 1, n_cands):
+            if cluster_sorted[index] >= 0:
+                continue
+            if relate_kernel(period_sorted[base], period_sorted[index], dm_sorted[base],
+                             dm_sorted[index], acc_sorted[base], acc_sorted[index],
+                             obs_length, obs_length_over_c, max_distance_dm,
+                             max_distance_broadened_period):
+                cluster_sorted[index] = cluster_id
+            # Break loop when periods are too far from each other
+            elif abs(base_rotations - obs_length / period_sorted[index]) > max_distance_period:
+                break
+
+        # Cycle through the periods lower than the base_period
+        for index in range(base - 1, -1, -1):
+            if cluster_sorted[index] >= 0:
+                continue
+            if relate_kernel(period_sorted[index], period_sorted[base], dm_sorted[index],
+                             dm_sorted[base], acc_sorted[index], acc_sorted[base],
+                             obs_length, obs_length_over_c, max_distance_dm,
+                             max_distance_broadened_period):
+                cluster_sorted[index] = cluster_id
+            elif abs(base_rotations - obs_length / period_sorted[index]) > max_distance_period:
+                break
+
+        cluster_id += 1
+
+    return cluster_sorted, strongest
+
+
+def cluster_cand_arrays_numba(period, dm, acc, obs_meta_data, config):
+    # Cluster candidates given as arrays which are sorted by snr
+    # Gives the same result as cluster_cand_df_reference
+
+    # Same ordering as sort_values('period') in the reference implementation
+    period_order = np.argsort(period, kind='quicksort')
+    period_position = np.empty(len(period), dtype=np.intp)
+    period_position[period_order] = np.arange(len(period))
+
+    cluster_sorted, strongest = cluster_sorted_kernel(
+        np.ascontiguousarray(period[period_order], dtype=np.float64),
+        np.ascontiguousarray(dm[period_order], dtype=np.float64),
+        np.ascontiguousarray(acc[period_order], dtype=np.float64),
+        period_position,
+        float(obs_meta_data["obs_length"]), float(obs_meta_data["obs_length_over_c"]),
+        float(config['max_distance_period']), float(config['max_distance_dm']),
+        float(config['max_distance_broadened_period']))
+    return cluster_sorted[period_position], strongest
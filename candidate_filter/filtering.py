@@ -1,43 +1,53 @@
-def filter_clusters(df_cands, df_clusters, config):
-    # Filter out bad candidates
-    # Creating a class to do the filtering might make things simpler..
-    min_decay_value = config['min_spatial_decay']
-    min_total_nassoc = config['min_total_nassoc']
+import pandas as pd
+
+
+def spatial_rfi_rule(df_clusters, config):
+    # Clusters whose snr does not decay fast enough with the distance
+    decay_value = df_clusters['fit_decay'] + df_clusters['fit_decay_error']
+    return decay_value < config['min_spatial_decay']
+
 
-    df_cands['spatial_rfi'] = 0
-    df_clusters['spatial_rfi'] = 0
+def low_nassoc_rule(df_clusters, config):
+    # Clusters with too few associated candidates
+    return df_clusters['total_nassoc'] < config['min_total_nassoc']
 
-    df_cands['low_nassoc'] = 0
-    df_clusters['low_nassoc'] = 0
 
-    for (index, cluster) in df_clusters.iterrows():
+# Rules used to label bad clusters, each rule creates a column of the same name
+# A rule gets the cluster DataFrame and the config and returns a boolean Series
+# New filters can be added here or passed to filter_clusters
+filter_rules = {'spatial_rfi': spatial_rfi_rule,
+                'low_nassoc': low_nassoc_rule}
 
-        cluster_id = cluster['cluster_id']
 
-        # First label spatial RFI
-        decay_value = cluster['fit_decay'] + cluster['fit_decay_error']
+def label_clusters(df_clusters, config, rules=filter_rules):
+    # Label the clusters, each rule creates a column
+    for name, rule in rules.items():
+        df_clusters[name] = rule(df_clusters, config).astype(int).values
+    return df_clusters
 
-        if decay_value < min_decay_value:
-            df_clusters.loc[cluster.name, 'spatial_rfi'] = 1
-            df_cands.loc[df_cands['cluster_id']
-                         == cluster_id, 'spatial_rfi'] = 1
 
-        # Label low nassoc:
-        total_nassoc = cluster['total_nassoc']
-        if total_nassoc < min_total_nassoc:
-            df_clusters.loc[cluster.name, 'low_nassoc'] = 1
-            df_cands.loc[df_cands['cluster_id']
-                         == cluster_id, 'low_nassoc'] = 1
+def label_candidates(df_cands, df_clusters, rules=filter_rules):
+    # Copy the labels to the candidates of each cluster
+    cluster_positions = pd.Index(df_clusters['cluster_id']).get_indexer(
+        df_cands['cluster_id'])
+    for name in rules:
+        df_cands[name] = df_clusters[name].values[cluster_positions]
+    return df_cands
+
+
+def filter_clusters(df_cands, df_clusters, config, rules=filter_rules):
+    # Filter out bad candidates
+    df_clusters = label_clusters(df_clusters, config, rules)
+    df_cands = label_candidates(df_cands, df_clusters, rules)
 
     print(f"Clusters: {len(df_clusters)}")
-    print(f"RFI Clusters: {len(df_clusters[df_clusters['spatial_rfi']==1])}")
-    print(f"RFI Candidates: {len(df_cands[df_cands['spatial_rfi']==1])}")
-    print(f"Low nassoc Candidates: {len(df_cands[df_cands['low_nassoc']==1])}")
+    for name in rules:
+        print(f"Clusters labelled {name}: {df_clusters[name].sum()}")
+        print(f"Candidates labelled {name}: {df_cands[name].sum()}")
 
-    good_files = df_cands[(df_cands['spatial_rfi'] == 0) &
-                          (df_cands['low_nassoc'] == 0)]
+    # Good files == not labelled by any rule
+    good_files = df_cands[(df_cands[list(rules)] == 0).all(axis=1)]
 
-    # Good files == neither RFI nor low nassoc
     print(f"Good Candidates: {len(good_files)}")
     # Good files to fold == good files which are the strongest in their cluster
     print(
@@ -0,0 +1,113 @@
+import numpy as np
+from math import gcd
+
+
+def harmonic_ratios(max_harmonic):
+    # All reduced ratios n/m with 1 <= n, m <= max_harmonic except 1
+    ratios = set()
+    for numerator in range(1, max_harmonic + 1):
+        for denominator in range(1, max_harmonic + 1):
+            if numerator != denominator and gcd(numerator, denominator) == 1:
+                ratios.add(numerator / denominator)
+    return np.array(sorted(ratios))
+
+
+def find_harmonic_pairs(period, dm, acc, obs_meta_data, config):
+    # Find pairs of candidates whose periods are close to a small-integer ratio
+    # The periods are sorted, so every ratio only needs a searchsorted window
+    # for each candidate instead of a comparison with all candidates
+    # Returns two arrays of indices, period[second] ~ ratio * period[first]
+    obs_length = obs_meta_data["obs_length"]
+    max_rotations = config.get('max_distance_harmonic_period',
+                               config['max_distance_broadened_period'])
+    max_dm = config.get('max_distance_harmonic_dm', config['max_distance_dm'])
+    max_acc = config.get('max_distance_harmonic_acc', np.inf)
+
+    # Work in order of period, so the searched values are sorted as well, which is much faster
+    order = np.argsort(period)
+    sorted_period = period[order]
+    first_list = []
+    second_list = []
+    for ratio in harmonic_ratios(config.get('max_harmonic', 16)):
+        # Periods with less than max_rotations difference to ratio * period
+        # 1 / period_2 is within 1 / expected_period +- max_rotations / obs_length
+        expected_period = ratio * sorted_period
+        max_frequency_difference = max_rotations * expected_period / obs_length
+        lower_period = expected_period / (1 + max_frequency_difference)
+        with np.errstate(divide='ignore'):
+            upper_period = np.where(max_frequency_difference < 1,
+                                    expected_period / (1 - max_frequency_difference), np.inf)
+        lower = np.searchsorted(sorted_period, lower_period, side='left')
+        upper = np.searchsorted(sorted_period, upper_period, side='right')
+        window_sizes = upper - lower
+        n_pairs = window_sizes.sum()
+        if n_pairs == 0:
+            continue
+
+        first = np.repeat(np.arange(len(period)), window_sizes)
+        offsets = np.arange(n_pairs) - np.repeat(np.cumsum(window_sizes) - window_sizes, window_sizes)
+        second = np.repeat(lower, window_sizes) + offsets
+        first, second = order[first], order[second]
+
+        rotation_difference = np.abs(obs_length / period[second] - obs_length / (ratio * period[first]))
+        related = (rotation_difference < max_rotations) & \
+            (np.abs(dm[second] - dm[first]) < max_dm) & \
+            (np.abs(acc[second] - acc[first]) < max_acc)
+        first_list.append(first[related])
+        second_list.append(second[related])
+
+    if len(first_list) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    return np.concatenate(first_list), np.concatenate(second_list)
+
+
+def harmonic_roots(cluster_ids, first, second):
+    # Assign each cluster to the strongest related cluster which is not itself a harmonic
+    # Clusters are processed in order of snr like the candidates in cluster_cand_df,
+    # so families do not grow by chains of harmonics of harmonics
+    # Returns the position of the root cluster for each cluster
+    root = np.arange(len(cluster_ids))
+    # Pairs in both directions from the weaker to the stronger cluster
+    weaker = np.concatenate([first, second])
+    stronger = np.concatenate([second, first])
+    keep = cluster_ids[stronger] < cluster_ids[weaker]
+    weaker, stronger = weaker[keep], stronger[keep]
+    order = np.lexsort((cluster_ids[stronger], cluster_ids[weaker]))
+    for weak, strong in zip(weaker[order], stronger[order]):
+        # The first root found is the strongest, as the pairs are sorted
+        if root[weak] == weak and root[strong] == strong:
+            root[weak] = strong
+    return root
+
+
+def associate_harmonics(df_cands, obs_meta_data, config):
+    # Merge clusters whose best candidates are harmonically related
+    # Each family of harmonics gets the cluster_id of its strongest cluster
+    # The cluster_id without harmonics is kept in cluster_id_no_harmonics
+    df_best = df_cands[df_cands['strongest_in_cluster'] == 1]
+    cluster_ids = df_best['cluster_id'].to_numpy()
+    best_periods = df_best['period'].to_numpy(dtype=float)
+
+    first, second = find_harmonic_pairs(best_periods,
+                                         df_best['dm'].to_numpy(dtype=float),
+                                         df_best['acc'].to_numpy(dtype=float),
+                                         obs_meta_data, config)
+    root = harmonic_roots(cluster_ids, first, second)
+    new_cluster_id = cluster_ids[root]
+    harmonic_ratio = best_periods / best_periods[root]
+
+    # Position of the cluster of each candidate in df_best
+    cluster_position = np.zeros(cluster_ids.max() + 1 if len(cluster_ids) else 0, dtype=int)
+    cluster_position[cluster_ids] = np.arange(len(cluster_ids))
+    cand_position = cluster_position[df_cands['cluster_id'].to_numpy()]
+
+    df_cands['cluster_id_no_harmonics'] = df_cands['cluster_id']
+    df_cands['harmonic_ratio'] = harmonic_ratio[cand_position]
+    df_cands['cluster_id'] = new_cluster_id[cand_position]
+    # Only the strongest candidate of a family stays the strongest in its cluster
+    df_cands['strongest_in_cluster'] = (
+        (df_cands['strongest_in_cluster'] == 1) &
+        (df_cands['cluster_id'] == df_cands['cluster_id_no_harmonics'])).astype(int)
+    n_merged = len(cluster_ids) - len(np.unique(new_cluster_id))
+    print(f"{n_merged} clusters merged into harmonic families.")
+    return df_cands
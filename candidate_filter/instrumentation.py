@@ -0,0 +1,77 @@
+import cProfile
+import json
+import resource
+import time
+from contextlib import contextmanager
+
+
+# Stages of the pipeline that can be profiled
+stage_names = ['read', 'known_sources', 'cluster', 'harmonics', 'spatial_rfi', 'filter', 'write', 'plot']
+
+
+def max_rss():
+    # Peak resident memory in MB of the process and of its finished child processes
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return own, children
+
+
+def children_cpu_time():
+    # Cpu time of finished child processes, e.g. the workers of a process pool
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class RunReport:
+    # Collects wall time, cpu time, memory and row counts of the pipeline stages
+    # profile_stage is run under cProfile and the statistics are written to profile_path
+
+    def __init__(self, profile_stage=None, profile_path=''):
+        self.profile_stage = profile_stage
+        self.profile_path = profile_path
+        self.stages = []
+        self.start_time = time.time()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        # Measure a stage, rows_out can be set in the yielded dict
+        record = {'stage': name, 'rows_in': rows_in, 'rows_out': None}
+        profiler = cProfile.Profile() if name == self.profile_stage else None
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        children_cpu_start = children_cpu_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(self.profile_path)
+            record['wall_time'] = time.perf_counter() - wall_start
+            record['cpu_time'] = time.process_time() - cpu_start
+            record['children_cpu_time'] = children_cpu_time() - children_cpu_start
+            # ru_maxrss only increases, so this is the peak up to the end of the stage
+            record['max_rss_mb'], record['max_rss_children_mb'] = max_rss()
+            self.stages.append(record)
+
+    def summary(self):
+        # Machine readable summary of the run
+        return {'start_time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.start_time)),
+                'total_wall_time': time.perf_counter() - self.wall_start,
+                'total_cpu_time': time.process_time() - self.cpu_start,
+                # ru_maxrss never resets, in a batch worker it includes earlier pointings
+                'max_rss_mb': max_rss()[0],
+                'max_rss_scope': 'peak of the process since it started, not of this run',
+                'profile_stage': self.profile_stage,
+                'stages': self.stages}
+
+    def write(self, path, **extra_values):
+        # Write the summary and additional values as json
+        report = self.summary()
+        report.update(extra_values)
+        with open(path, 'w') as json_file:
+            json.dump(report, json_file, indent=2, default=str)
@@ -0,0 +1,153 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+
+# Columns of a known source file and the values used when a column or value is missing
+# period_tolerance is relative to the period, dm_tolerance is absolute
+# A missing dm matches all dms, e.g. for RFI
+# max_harmonic adds the periods period / n and period * n for n <= max_harmonic
+# action 'tag' only names the matching candidates, 'drop' removes them before the clustering
+known_source_defaults = {'dm': np.nan,
+                         'period_tolerance': 1e-4,
+                         'dm_tolerance': 5.,
+                         'max_harmonic': 1,
+                         'action': 'tag'}
+
+known_source_actions = ['tag', 'drop']
+
+# Known sources loaded in this process, reused by the following pointings of a batch
+loaded_sources = {}
+
+
+def read_known_sources(path):
+    # Read a csv or json file with one known source per row
+    # The file needs at least the columns name and period
+    if path.endswith('.json'):
+        with open(path) as json_file:
+            sources = json.load(json_file)
+        # An empty list has no columns, it is read like a csv file with only a header
+        df_sources = pd.DataFrame(sources) if sources else pd.DataFrame(columns=['name', 'period'])
+    else:
+        df_sources = pd.read_csv(path, comment='#', skipinitialspace=True)
+
+    for column in ['name', 'period']:
+        if column not in df_sources:
+            raise ValueError(f"Known source file {path} has no column {column}.")
+    for column, default in known_source_defaults.items():
+        if column not in df_sources:
+            df_sources[column] = default
+        else:
+            df_sources[column] = df_sources[column].fillna(default)
+    unknown_actions = set(df_sources['action']) - set(known_source_actions)
+    if unknown_actions:
+        raise ValueError(f"Unknown known source actions {sorted(unknown_actions)}, "
+                         f"options are {known_source_actions}")
+    df_sources['name'] = df_sources['name'].astype(str)
+    return df_sources.reset_index(drop=True)
+
+
+def build_index(df_sources):
+    # Arrays of all known periods including the harmonics, sorted by the lower period bound
+    if len(df_sources) == 0:
+        # A file without sources matches no candidates
+        no_values = np.zeros(0)
+        return {'source_row': np.zeros(0, dtype=np.int64), 'period': no_values,
+                'lower': no_values, 'upper': no_values, 'max_width': 0.,
+                'dm': no_values, 'dm_tolerance': no_values}
+    source_rows = []
+    periods = []
+    for harmonic in range(1, int(df_sources['max_harmonic'].max()) + 1):
+        with_harmonic = np.flatnonzero(df_sources['max_harmonic'].to_numpy() >= harmonic)
+        for ratio in {harmonic, 1 / harmonic}:
+            source_rows.append(with_harmonic)
+            periods.append(df_sources['period'].to_numpy(dtype=float)[with_harmonic] * ratio)
+    source_rows = np.concatenate(source_rows)
+    periods = np.concatenate(periods)
+
+    tolerances = periods * df_sources['period_tolerance'].to_numpy(dtype=float)[source_rows]
+    order = np.argsort(periods - tolerances, kind='stable')
+    source_rows = source_rows[order]
+    periods = periods[order]
+    tolerances = tolerances[order]
+    return {'source_row': source_rows,
+            'period': periods,
+            'lower': periods - tolerances,
+            'upper': periods + tolerances,
+            'max_width': 2 * tolerances.max() if len(tolerances) else 0.,
+            'dm': df_sources['dm'].to_numpy(dtype=float)[source_rows],
+            'dm_tolerance': df_sources['dm_tolerance'].to_numpy(dtype=float)[source_rows]}
+
+
+def load_known_sources(path):
+    # Read and index a known source file once per process
+    # The file is read again when it was modified
+    key = (os.path.abspath(path), os.stat(path).st_mtime_ns)
+    if key not in loaded_sources:
+        df_sources = read_known_sources(path)
+        loaded_sources[key] = (df_sources, build_index(df_sources))
+    return loaded_sources[key]
+
+
+def match_known_sources(period, dm, index):
+    # Row of the matching known source for each candidate, -1 without a match
+    # Only the entries with a lower bound in [period - max_width, period] can match,
+    # they are found with searchsorted instead of comparing all entries
+    # When several entries match, the one with the closest period is used
+    period = np.asarray(period, dtype=float)
+    dm = np.asarray(dm, dtype=float)
+    lower = np.searchsorted(index['lower'], period - index['max_width'], side='left')
+    upper = np.searchsorted(index['lower'], period, side='right')
+    window_sizes = upper - lower
+
+    cands = np.repeat(np.arange(len(period)), window_sizes)
+    offsets = np.arange(window_sizes.sum()) - np.repeat(np.cumsum(window_sizes) - window_sizes,
+                                                        window_sizes)
+    entries = np.repeat(lower, window_sizes) + offsets
+    dm_difference = np.abs(dm[cands] - index['dm'][entries])
+    matches = (period[cands] <= index['upper'][entries]) & \
+        (np.isnan(index['dm'][entries]) | (dm_difference <= index['dm_tolerance'][entries]))
+    cands = cands[matches]
+    entries = entries[matches]
+
+    # Closest period first, the first entry of each candidate is used
+    order = np.lexsort((np.abs(period[cands] / index['period'][entries] - 1), cands))
+    cands = cands[order]
+    entries = entries[order]
+    first = np.flatnonzero(np.diff(cands, prepend=-1) != 0)
+
+    source_rows = np.full(len(period), -1, dtype=np.int64)
+    source_rows[cands[first]] = index['source_row'][entries[first]]
+    return source_rows
+
+
+def classify_candidates(period, dm, path):
+    # Match candidates with the known sources in the file path
+    # Returns the code of the matching name for each candidate (-1 without a match),
+    # the names and a mask of the candidates of sources with action 'drop'
+    df_sources, index = load_known_sources(path)
+    source_rows = match_known_sources(period, dm, index)
+    matched = source_rows >= 0
+
+    # Several entries can have the same name, e.g. a pulsar with different tolerances
+    names, name_codes = np.unique(df_sources['name'].to_numpy(dtype=str), return_inverse=True)
+    codes = np.full(len(source_rows), -1, dtype=np.int64)
+    codes[matched] = name_codes[source_rows[matched]]
+    drop_sources = df_sources['action'].to_numpy() == 'drop'
+    dropped = np.zeros(len(source_rows), dtype=bool)
+    dropped[matched] = drop_sources[source_rows[matched]]
+    return codes, names, dropped
+
+
+def apply_known_sources(df_cands, path):
+    # Name the candidates matching a known source in the column known_source and
+    # remove the candidates of sources with action 'drop'
+    # Returns the remaining and the removed candidates
+    codes, names, dropped = classify_candidates(df_cands['period'], df_cands['dm'], path)
+    df_cands['known_source'] = pd.Categorical.from_codes(codes, names)
+    df_dropped = df_cands[dropped].reset_index(drop=True)
+    df_cands = df_cands[~dropped].reset_index(drop=True)
+
+    print(f"{(codes >= 0).sum()} candidates match known sources, {dropped.sum()} are removed.")
+    return df_cands, df_dropped
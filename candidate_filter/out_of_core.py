@@ -0,0 +1,396 @@
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import reading_cands
+import cluster_cands
+import spatial_rfi
+import filtering
+import writing_cands
+
+
+# Number of candidates kept in memory while reading before they are written to disk
+buffer_rows = 1000000
+
+# Columns of the partition files which are not read from the candidate files
+index_columns = ['cand_id_in_file', 'file_index', 'cand_index', 'period_slice']
+
+# Columns of the strongest candidates per beam used in the spatial stage
+spatial_columns = ['cluster_id', 'file_index', 'snr']
+
+
+# The candidates are split into slices of max_distance_period rotations.
+# A band is a range of slices (its core) together with the slices within the
+# largest distance at which candidates can be related (its margin).
+# Every band is clustered on its own, a cluster belongs to the band whose core
+# contains the strongest candidate of the cluster.
+
+
+def check_out_of_core_args(args, config):
+    # Options which need all candidates in memory
+    if args.plot:
+        raise ValueError("Plots are not supported in the out-of-core mode.")
+    if args.artifacts:
+        raise ValueError("Artifacts are not supported in the out-of-core mode.")
+    if args.beam_format != ['csv']:
+        raise ValueError("The out-of-core mode only writes csv files.")
+    if config.get('harmonic_clustering', False):
+        raise ValueError("harmonic_clustering is not supported in the out-of-core mode.")
+    if config.get('known_sources_file'):
+        raise ValueError("Known sources are not supported in the out-of-core mode.")
+
+
+def save_columns(path, columns):
+    # Write each column as .npy file, so that parts of it can be read with memory mapping
+    os.makedirs(path, exist_ok=True)
+    for name, values in columns.items():
+        np.save(os.path.join(path, f"{name}.npy"), values)
+    with open(os.path.join(path, 'columns.json'), 'w') as json_file:
+        json.dump(list(columns), json_file)
+
+
+def load_columns(path):
+    with open(os.path.join(path, 'columns.json')) as json_file:
+        names = json.load(json_file)
+    return {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in names}
+
+
+def flush_buffer(buffer, part_path, slice_width, obs_meta_data):
+    # Write the buffered beams as one part, sorted by period slice
+    columns = {name: np.concatenate([beam[name] for beam in buffer]) for name in buffer[0]}
+    rotations = obs_meta_data['obs_length'] / columns['period']
+    columns['period_slice'] = np.floor(rotations / slice_width).astype(np.int64)
+    order = np.argsort(columns['period_slice'], kind='stable')
+    columns = {name: values[order] for name, values in columns.items()}
+    save_columns(part_path, columns)
+    return np.unique(columns['period_slice'], return_counts=True), \
+        (columns['acc'].min(), columns['acc'].max())
+
+
+def partition_candidates(files, work_dir, config, n_jobs=1, cache_dir=None, cache_mode='off'):
+    # Read the beams and write the candidates to disk, sorted by period slice
+    # Only buffer_rows candidates are kept in memory
+    # Returns the paths of the parts, the number of candidates in each slice,
+    # the range of acc, the beam table and the meta data of the observation
+    if cache_mode == 'off':
+        read_function = reading_cands.read_beam
+    else:
+        read_function = partial(reading_cands.read_beam_cached, cache_dir=cache_dir,
+                                rebuild=cache_mode == 'rebuild')
+    slice_width = config['max_distance_period']
+
+    headers = []
+    buffer = []
+    n_buffered = 0
+    n_cands = 0
+    part_paths = []
+    slice_counts = []
+    acc_ranges = []
+
+    executor = ProcessPoolExecutor(max_workers=n_jobs) if n_jobs > 1 else None
+    beams = executor.map(read_function, files) if executor else map(read_function, files)
+    try:
+        for file_index, (columns, header) in enumerate(beams):
+            if file_index == 0:
+                obs_meta_data = reading_cands.observation_meta_data(header)
+            headers.append(header)
+            n_rows = len(columns['cand_id_in_file'])
+            columns = dict(columns)
+            columns['file_index'] = np.full(n_rows, file_index, dtype=np.int32)
+            # Position in the input files, identifies a candidate in all stages
+            columns['cand_index'] = np.arange(n_cands, n_cands + n_rows, dtype=np.int64)
+            n_cands += n_rows
+            buffer.append(columns)
+            n_buffered += n_rows
+
+            if n_buffered >= buffer_rows or file_index == len(files) - 1:
+                # Beams without candidates do not need a part
+                if n_buffered:
+                    part_path = os.path.join(work_dir, 'parts', f"part_{len(part_paths)}")
+                    counts, acc_range = flush_buffer(buffer, part_path, slice_width,
+                                                     obs_meta_data)
+                    part_paths.append(part_path)
+                    slice_counts.append(counts)
+                    acc_ranges.append(acc_range)
+                buffer = []
+                n_buffered = 0
+    finally:
+        if executor:
+            executor.shutdown()
+
+    slices = np.concatenate([counts[0] for counts in slice_counts])
+    counts = np.concatenate([counts[1] for counts in slice_counts])
+    slices, slice_index = np.unique(slices, return_inverse=True)
+    counts = np.bincount(slice_index.ravel(), weights=counts).astype(np.int64)
+    acc_range = (min(acc_min for acc_min, _ in acc_ranges), max(acc_max for _, acc_max in acc_ranges))
+    df_beams = reading_cands.beam_table(files, headers)
+    return part_paths, (slices, counts), acc_range, df_beams, obs_meta_data
+
+
+def band_margin(max_rotations, acc_range, obs_meta_data, config):
+    # Largest distance in rotations at which two candidates can be related
+    # The period window of the clustering and the broadening by the acc difference
+    max_broadening = max_rotations * (acc_range[1] - acc_range[0]) * obs_meta_data['obs_length_over_c']
+    return config['max_distance_period'] + config['max_distance_broadened_period'] + max_broadening
+
+
+def plan_bands(slice_counts, acc_range, obs_meta_data, config, band_rows):
+    # Split the slices into bands with about band_rows candidates in the core
+    # Returns a list of (core_start, core_stop, start, stop) in slices
+    slices, counts = slice_counts
+    slice_width = config['max_distance_period']
+    max_rotations = (slices[-1] + 1) * slice_width
+    margin = int(np.ceil(band_margin(max_rotations, acc_range, obs_meta_data, config) / slice_width))
+
+    bands = []
+    core_start = slices[0]
+    n_rows = 0
+    for slice_id, count in zip(slices, counts):
+        n_rows += count
+        if n_rows >= band_rows or slice_id == slices[-1]:
+            core_stop = slice_id + 1
+            bands.append((core_start, core_stop, core_start - margin, core_stop + margin))
+            core_start = core_stop
+            n_rows = 0
+    return bands
+
+
+def load_slices(part_paths, start, stop):
+    # Load the candidates in the slices [start, stop) of all parts
+    frames = []
+    for part_path in part_paths:
+        columns = load_columns(part_path)
+        lower, upper = np.searchsorted(columns['period_slice'], [start, stop], side='left')
+        if upper > lower:
+            frames.append(pd.DataFrame({name: np.array(values[lower:upper])
+                                        for name, values in columns.items()}))
+    df_cands = pd.concat(frames, ignore_index=True)
+    # Same order as read_candidate_files, ties are broken by the position in the input files
+    df_cands.sort_values(['snr', 'cand_index'], ascending=[False, True], inplace=True,
+                         kind='mergesort')
+    df_cands.reset_index(inplace=True, drop=True)
+    return df_cands
+
+
+def cluster_band(band_index, bands, part_paths, work_dir, obs_meta_data, config):
+    # Cluster the candidates of a band and write the claims of the clusters owned by the band
+    # A claim is a candidate with the strongest candidate (base) of its cluster
+    core_start, core_stop, start, stop = bands[band_index]
+    df_band = load_slices(part_paths, start, stop)
+    df_band = cluster_cands.cluster_cand_df(df_band, obs_meta_data, config)
+
+    # Cluster ids are given in order of snr, so are the strongest candidates
+    df_bases = df_band[df_band['strongest_in_cluster'] == 1]
+    cluster_ids = df_band['cluster_id'].to_numpy()
+    base_slice = df_bases['period_slice'].to_numpy()[cluster_ids]
+    owned = (base_slice >= core_start) & (base_slice < core_stop)
+
+    claims = {'cand_index': df_band['cand_index'].to_numpy()[owned],
+              'period_slice': df_band['period_slice'].to_numpy()[owned],
+              'base_index': df_bases['cand_index'].to_numpy()[cluster_ids][owned],
+              'base_snr': df_bases['snr'].to_numpy()[cluster_ids][owned]}
+    claims_path = os.path.join(work_dir, 'claims', f"band_{band_index}")
+    save_columns(claims_path, claims)
+    return claims_path
+
+
+def resolve_claims(band_index, bands, claims_paths, part_paths):
+    # Assign each candidate in the core of a band to the strongest cluster claiming it
+    # Conflicts between bands are resolved like in the clustering, the cluster with the
+    # stronger base takes the candidate
+    # Returns the assigned candidates and the candidates without any claim
+    core_start, core_stop, _, _ = bands[band_index]
+    claims = []
+    for other_index, (_, _, start, stop) in enumerate(bands):
+        if start < core_stop and stop > core_start:
+            columns = load_columns(claims_paths[other_index])
+            in_core = (columns['period_slice'] >= core_start) & (columns['period_slice'] < core_stop)
+            claims.append(pd.DataFrame({name: np.array(values[in_core])
+                                        for name, values in columns.items()}))
+    df_claims = pd.concat(claims, ignore_index=True)
+    df_claims.sort_values(['cand_index', 'base_snr', 'base_index'],
+                          ascending=[True, False, True], inplace=True, kind='mergesort')
+    df_claims.drop_duplicates('cand_index', inplace=True)
+
+    df_core = load_slices(part_paths, core_start, core_stop)
+    unclaimed = ~df_core['cand_index'].isin(df_claims['cand_index']).to_numpy()
+    return df_claims[['cand_index', 'base_index', 'base_snr']], df_core[unclaimed]
+
+
+def cluster_out_of_core(part_paths, bands, work_dir, obs_meta_data, config, n_jobs=1):
+    # Cluster all bands, in parallel with n_jobs, and combine the clusters
+    # Returns the base of each candidate for each band and the cluster_id of each base
+    cluster_function = partial(cluster_band, bands=bands, part_paths=part_paths,
+                               work_dir=work_dir, obs_meta_data=obs_meta_data, config=config)
+    if n_jobs > 1 and len(bands) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            claims_paths = list(executor.map(cluster_function, range(len(bands))))
+    else:
+        claims_paths = [cluster_function(band_index) for band_index in range(len(bands))]
+
+    assignment_paths = []
+    unclaimed = []
+    for band_index in range(len(bands)):
+        df_assigned, df_unclaimed = resolve_claims(band_index, bands, claims_paths, part_paths)
+        assignment_path = os.path.join(work_dir, 'assignments', f"band_{band_index}")
+        save_columns(assignment_path, {name: df_assigned[name].to_numpy()
+                                       for name in df_assigned.columns})
+        assignment_paths.append(assignment_path)
+        unclaimed.append(df_unclaimed)
+
+    # Candidates which were not taken by any owned cluster form new clusters
+    df_unclaimed = pd.concat(unclaimed, ignore_index=True)
+    df_unclaimed.sort_values(['snr', 'cand_index'], ascending=[False, True], inplace=True,
+                             kind='mergesort')
+    df_unclaimed.reset_index(inplace=True, drop=True)
+    if len(df_unclaimed):
+        df_unclaimed = cluster_cands.cluster_cand_df(df_unclaimed, obs_meta_data, config)
+        df_unclaimed_bases = df_unclaimed[df_unclaimed['strongest_in_cluster'] == 1]
+        cluster_ids = df_unclaimed['cluster_id'].to_numpy()
+        df_unclaimed['base_index'] = df_unclaimed_bases['cand_index'].to_numpy()[cluster_ids]
+        df_unclaimed['base_snr'] = df_unclaimed_bases['snr'].to_numpy()[cluster_ids]
+    else:
+        df_unclaimed['base_index'] = np.array([], dtype=np.int64)
+        df_unclaimed['base_snr'] = np.array([], dtype=float)
+
+    # Cluster ids in order of the snr of the bases like in cluster_cand_df
+    bases = [df_unclaimed[['base_index', 'base_snr']]]
+    for assignment_path in assignment_paths:
+        columns = load_columns(assignment_path)
+        bases.append(pd.DataFrame({'base_index': columns['base_index'],
+                                   'base_snr': columns['base_snr']}))
+    df_bases = pd.concat(bases, ignore_index=True).drop_duplicates('base_index')
+    df_bases.sort_values(['base_snr', 'base_index'], ascending=[False, True], inplace=True,
+                         kind='mergesort')
+    cluster_of_base = pd.Series(np.arange(len(df_bases)), index=df_bases['base_index'].to_numpy())
+
+    print(f"{len(bands)} bands clustered, {len(df_unclaimed)} candidates clustered again "
+          f"after combining the bands.")
+    return assignment_paths, df_unclaimed[['cand_index', 'base_index']], cluster_of_base
+
+
+def clustered_band(band_index, bands, part_paths, assignment_paths, df_unclaimed, cluster_of_base,
+                   df_beams):
+    # Candidates in the core of a band with their final cluster_id, sorted by snr
+    core_start, core_stop, _, _ = bands[band_index]
+    df_core = load_slices(part_paths, core_start, core_stop)
+    columns = load_columns(assignment_paths[band_index])
+    base_of_cand = pd.concat([pd.Series(np.array(columns['base_index']),
+                                        index=np.array(columns['cand_index'])),
+                              df_unclaimed.set_index('cand_index')['base_index']])
+    base_index = base_of_cand.reindex(df_core['cand_index']).to_numpy()
+
+    df_core['file'] = df_beams['file'].values.take(df_core['file_index'].to_numpy())
+    df_core['cluster_id'] = cluster_of_base.reindex(base_index).to_numpy()
+    df_core['strongest_in_cluster'] = (base_index == df_core['cand_index'].to_numpy()).astype(int)
+    # The position in the input files is the index of the candidates in the output
+    df_core.index = df_core.pop('cand_index').rename(None)
+    return df_core.drop(columns='period_slice')
+
+
+def write_beam_chunks(df_cands, output_folder, written_beams):
+    # Append the candidates of each beam to the csv files of the single beams
+    for file_index, df_file in df_cands.groupby('file_index', sort=False):
+        path = os.path.join(output_folder, f"{writing_cands.beam_name(df_file['file'].iloc[0])}.csv")
+        new_file = file_index not in written_beams
+        df_file.to_csv(path, mode='w' if new_file else 'a', header=new_file)
+        written_beams.add(file_index)
+
+
+def run_out_of_core(args, config, report, band_rows=1000000):
+    # Filter the candidates of a pointing without loading all candidates at once
+    # Intermediate files are written to a new folder next to the output, which is
+    # removed at the end, also when the run fails
+    check_out_of_core_args(args, config)
+    output_folder = os.path.dirname(args.output) or '.'
+    os.makedirs(output_folder, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix='out_of_core_', dir=output_folder)
+    try:
+        filter_out_of_core(args, config, report, work_dir, band_rows)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def filter_out_of_core(args, config, report, work_dir, band_rows):
+    # Stages of the out-of-core mode, work_dir holds the intermediate files
+    output_folder = os.path.dirname(args.output)
+    cache_dir = args.cache_dir or os.path.join(output_folder, 'candidate_cache')
+
+    with report.stage('read', rows_in=len(args.input)) as stage:
+        part_paths, slice_counts, acc_range, df_beams, obs_meta_data = partition_candidates(
+            args.input, work_dir, config, n_jobs=args.jobs, cache_dir=cache_dir,
+            cache_mode=args.cache)
+        n_cands = int(slice_counts[1].sum())
+        stage['rows_out'] = n_cands
+    print(f"{n_cands} candidates read.")
+
+    with report.stage('cluster', rows_in=n_cands) as stage:
+        bands = plan_bands(slice_counts, acc_range, obs_meta_data, config, band_rows)
+        assignment_paths, df_unclaimed, cluster_of_base = cluster_out_of_core(
+            part_paths, bands, work_dir, obs_meta_data, config, n_jobs=args.jobs)
+        stage['rows_out'] = len(cluster_of_base)
+
+    # The spatial stage only needs the aggregated values and the strongest candidate
+    # of each cluster, which are collected band by band, and the strongest candidate
+    # in each beam of the clusters seen in more than one beam
+    with report.stage('spatial_rfi', rows_in=n_cands) as stage:
+        aggregates = []
+        best = []
+        strongest = []
+        for band_index in range(len(bands)):
+            df_core = clustered_band(band_index, bands, part_paths, assignment_paths,
+                                     df_unclaimed, cluster_of_base, df_beams)
+            aggregates.append(spatial_rfi.aggregate_clusters(df_core))
+            best.append(spatial_rfi.best_candidate_rows(df_core))
+            strongest.append(df_core.drop_duplicates(['cluster_id', 'file_index'])[spatial_columns])
+        df_stats = spatial_rfi.combine_aggregates(aggregates)
+        df_best = spatial_rfi.combine_best_candidates(best)
+        df_strongest = pd.concat(strongest)
+        df_strongest['cand_index'] = df_strongest.index
+        df_strongest.sort_values(['snr', 'cand_index'], ascending=[False, True], inplace=True,
+                                 kind='mergesort')
+        df_strongest = df_strongest.drop_duplicates(['cluster_id', 'file_index']).drop(
+            columns='cand_index')
+        n_cluster_beams = df_strongest.groupby('cluster_id')['file_index'].transform('size')
+        df_strongest = df_strongest[n_cluster_beams.to_numpy() > 1]
+        df_clusters = spatial_rfi.label_spatial_rfi(df_strongest, df_beams, config,
+                                                    n_jobs=args.jobs, df_stats=df_stats,
+                                                    df_best=df_best)
+        stage['rows_out'] = len(df_clusters)
+
+    with report.stage('filter', rows_in=len(df_clusters)) as stage:
+        df_clusters = filtering.label_clusters(df_clusters, config)
+        rule_names = list(filtering.filter_rules)
+        stage['rows_out'] = int((~df_clusters[rule_names].any(axis=1)).sum())
+
+    # Write the candidates band by band
+    with report.stage('write', rows_in=n_cands) as stage:
+        df_clusters.to_csv(f"{args.output}_clusters.csv")
+        beam_folder = os.path.join(output_folder, 'single_beams')
+        os.makedirs(beam_folder, exist_ok=True)
+        written_beams = set()
+        labelled = pd.Series(0, index=rule_names)
+        n_good = 0
+        for band_index in range(len(bands)):
+            df_core = clustered_band(band_index, bands, part_paths, assignment_paths,
+                                     df_unclaimed, cluster_of_base, df_beams)
+            df_core = filtering.label_candidates(df_core, df_clusters)
+            labelled += df_core[rule_names].sum()
+            n_good += int((df_core[rule_names] == 0).all(axis=1).sum())
+
+            df_output = reading_cands.join_beam_columns(df_core, df_beams)
+            df_output.to_csv(f"{args.output}_cands.csv", mode='w' if band_index == 0 else 'a',
+                             header=band_index == 0)
+            write_beam_chunks(df_output, beam_folder, written_beams)
+        stage['rows_out'] = len(written_beams)
+
+    print(f"Clusters: {len(df_clusters)}")
+    for name in rule_names:
+        print(f"Clusters labelled {name}: {df_clusters[name].sum()}")
+        print(f"Candidates labelled {name}: {labelled[name]}")
+    print(f"Good Candidates: {n_good}")
+    print(f"Good Clusters: {(df_clusters[rule_names] == 0).all(axis=1).sum()}")
@@ -0,0 +1,137 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+# Plots are only written to files
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import reading_cands
+import spatial_rfi
+
+
+# Maximum number of candidates shown in the background of the period-acc panel
+max_background_points = 20000
+
+# Values that are the same in all plots, set once in every worker
+background = {}
+
+
+def set_background(background_values):
+    background.update(background_values)
+
+
+def create_background(df_cands, df_positions):
+    # Downsampled candidates for the period-acc panel and the limits of the sky panel
+    if len(df_cands) > max_background_points:
+        df_sample = df_cands.sample(n=max_background_points, random_state=0)
+    else:
+        df_sample = df_cands
+    return {'period': df_sample['period'].values,
+            'acc': df_sample['acc'].values,
+            'snr': df_sample['snr'].values,
+            'ra_limits': (df_positions['src_rajd'].min() - 0.01, df_positions['src_rajd'].max() + 0.01),
+            'dec_limits': (df_positions['src_dejd'].min() - 0.01, df_positions['src_dejd'].max() + 0.01)}
+
+
+def cluster_plot_values(cluster, df_beams, df_truncated):
+    # Collect the values needed to plot a single cluster
+    snr_vals = df_beams['snr'].values
+    max_pos = snr_vals.argmax()
+    distances = spatial_rfi.angular_distance_matrix(
+        df_beams['src_rajd'].values[[max_pos]], df_beams['src_dejd'].values[[max_pos]],
+        df_beams['src_rajd'].values, df_beams['src_dejd'].values)
+    return {'cluster': cluster.to_dict(),
+            'beam_rajd': df_beams['src_rajd'].values,
+            'beam_dejd': df_beams['src_dejd'].values,
+            'snr_vals': snr_vals,
+            'distances_from_max': distances[0],
+            'period': df_truncated['period'].values,
+            'acc': df_truncated['acc'].values,
+            'dm': df_truncated['dm'].values,
+            'snr': df_truncated['snr'].values}
+
+
+def plot_cluster(values, output_folder):
+    # Plot diagnostic plots
+    cluster = values['cluster']
+    fit_parameters = [cluster['fit_amplitude'], cluster['fit_decay']]
+    distances_from_max = values['distances_from_max']
+    snr_vals = values['snr_vals']
+
+    fig, (ax1, ax2, ax3, ax4) = plt.subplots(1, 4, figsize=(25, 4))
+
+    ax1.scatter(values['beam_rajd'], values['beam_dejd'], s=snr_vals * 1.5)
+    ax1.set_xlim(*background['ra_limits'])
+    ax1.set_ylim(*background['dec_limits'])
+    ax1.set(xlabel='src_rajd', ylabel='src_dejd')
+    ax1.set_title(f"{cluster['cluster_size']} candidates in {cluster['cluster_beams']} beams")
+
+    if len(snr_vals) > 3:
+        new_xvals = np.linspace(0, distances_from_max.max(), 20)
+        new_yvals = spatial_rfi.decay_law(new_xvals, *fit_parameters)
+        ax2.plot(new_xvals, new_yvals)
+    ax2.scatter(distances_from_max, snr_vals)
+    ax2.set_title(f"a*exp(-b*x); b={fit_parameters[1]}")
+    ax2.set(xlabel='Distance (´)', ylabel='snr')
+
+    ax3.scatter(background['period'], background['acc'],
+                s=background['snr'] * 2, c='r')
+    ax3.scatter(values['period'], values['acc'], s=values['snr'] * 2)
+    border = (values['period'].max() - values['period'].min()) * 0.1
+    if border == 0:
+        border = cluster['best_period'] * 0.02
+    ax3.set_xlim(values['period'].min() - border, values['period'].max() + border)
+    ax3.set(xlabel='period', ylabel='acc')
+    ax3.set_title(f"P0:  {cluster['best_period']}; Range: {cluster['period_range']}")
+
+    ax4.scatter(values['period'], values['dm'], s=values['snr'] * 2)
+    ax4.set_xlim(values['period'].min() - border, values['period'].max() + border)
+    ax4.set(xlabel='period', ylabel='DM')
+    ax4.set_title(f"DM: {cluster['min_dm']} - {cluster['max_dm']}")
+
+    fig.savefig(f"{output_folder}cluster_{cluster['cluster_id']}_Size_{cluster['cluster_size']}_P0_{cluster['best_period']}.png",
+                bbox_inches='tight')
+    plt.close(fig)
+
+
+def plot_cluster_chunk(values_list, output_folder):
+    for values in values_list:
+        plot_cluster(values, output_folder)
+
+
+def plot_clusters(df_clusters, df_cands, df_positions, output_folder, n_jobs=1, top_n=None):
+    # Plot diagnostic plots of all fitted clusters
+    # df_positions is the beam table with the position of each file_index
+    # top_n limits the plots to the largest clusters
+    os.makedirs(output_folder, exist_ok=True)
+
+    df_plotted = df_clusters[df_clusters['fit_status'] != 'not_fitted']
+    if top_n is not None:
+        df_plotted = df_plotted.iloc[:top_n]
+    if len(df_plotted) == 0:
+        return
+
+    df_cands_plotted = reading_cands.join_beam_columns(
+        df_cands[df_cands['cluster_id'].isin(df_plotted['cluster_id'])], df_positions)
+    df_beams_all = spatial_rfi.strongest_per_beam(df_cands_plotted)
+    beams_per_cluster = df_beams_all.groupby('cluster_id', sort=False).indices
+    cands_per_cluster = df_cands_plotted.groupby('cluster_id', sort=False).indices
+
+    values_list = []
+    for _, cluster in df_plotted.iterrows():
+        cluster_id = cluster['cluster_id']
+        values_list.append(cluster_plot_values(
+            cluster, df_beams_all.iloc[beams_per_cluster[cluster_id]],
+            df_cands_plotted.iloc[cands_per_cluster[cluster_id]]))
+
+    background_values = create_background(df_cands, df_positions)
+    if n_jobs > 1 and len(values_list) > 1:
+        n_chunks = min(len(values_list), 4 * n_jobs)
+        chunks = [values_list[chunk_index::n_chunks] for chunk_index in range(n_chunks)]
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=set_background,
+                                 initargs=(background_values,)) as executor:
+            # list() raises errors that happened during plotting
+            list(executor.map(plot_cluster_chunk, chunks, [output_folder] * n_chunks))
+    else:
+        set_background(background_values)
+        plot_cluster_chunk(values_list, output_folder)
@@ -1,48 +1,71 @@
+import numpy as np
 import pandas as pd
 import glob
 import xml.etree.ElementTree as ET
-from astropy import units as u
-from astropy.coordinates import SkyCoord
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import cand_cache
 
 
-def read_candidate_files(files, verbose=True):
+# Entries that are read from the candidate files and their types, all other entries are ignored
+# period and opt_period need double precision for the comparison of rotations,
+# snr is kept in double precision as it defines the order of the clustering
+column_types = {"period": np.float64, "opt_period": np.float64, "dm": np.float32,
+                "acc": np.float32, "nh": np.int32, "snr": np.float64, "folded_snr": np.float32,
+                "is_adjacent": np.int32, "is_physical": np.int32, "ddm_count_ratio": np.float32,
+                "ddm_snr_ratio": np.float32, "nassoc": np.int32, "byte_offset": np.int64}
+
+# Entries needed by the clustering and the filtering, a candidate without them is an error
+# Other missing entries are NaN in the float columns and -1 in the integer columns
+required_tags = ['period', 'dm', 'acc', 'snr', 'nassoc']
+
+# Columns of the beam table, which are joined to the candidates by file_index
+beam_columns = ['file_index', 'file', 'src_raj', 'src_rajd', 'src_dej', 'src_dejd']
+
+# Position of the header and the candidates in the children of the root element
+# Indexing might break when the candidate files look differently
+header_section = 1
+candidate_section = 6
+
+
+def read_candidate_files(files, verbose=True, n_jobs=1, cache_dir=None, cache_mode='off'):
     # Reads candidates files and include the candidates in a single pandas DataFrame
+    # The positions of the beams are returned in a separate table with one row per file
+    # cache_mode 'use' loads unchanged beams from cache_dir, 'rebuild' parses all
+    # files again and overwrites the cache, 'off' bypasses the cache
 
     #files = glob.glob(path + '*/overview.xml')
 
     if verbose:
         print(f"{len(files)} candidates files found.")
 
-    all_rows = []
-    file_index = 0
-    for file in files:
-        tree = ET.parse(file)
-        root = tree.getroot()
-
-        # Indexing might break when the candidate files look differently
-        candidates = root[6]
-
-        all_rows.extend(create_row(root, candidates, file, file_index))
-
-        # Grab needed meta data of obs
-        # Maybe should grab all values and check if comparison between files makes sense
-        if file_index == 0:
-            tsamp = float(root[1].find("tsamp").text)
-            nsamples = float(root[1].find("nsamples").text)
-            obs_length = tsamp * nsamples
-            speed_of_light = 299792458.0
-            obs_length_over_c = obs_length / speed_of_light
-            obs_meta_data = {"tsamp": tsamp,
-                             "nsamples": nsamples,
-                             "obs_length": obs_length,
-                             'obs_length_over_c': obs_length_over_c}
-        file_index += 1
-
-    df_candidates = pd.DataFrame(all_rows)
-
-    # Additional type casting may be necessary or not necessary at all
-    df_candidates = df_candidates.astype({"snr": float, "dm": float, "period": float,
-                                          "acc": float, "nassoc": int})
+    if cache_mode == 'off':
+        read_function = read_beam
+    else:
+        read_function = partial(read_beam_cached, cache_dir=cache_dir,
+                                rebuild=cache_mode == 'rebuild')
+
+    # Parse the beams in parallel, every beam is returned as columns of arrays
+    if n_jobs > 1 and len(files) > 1:
+        chunksize = max(1, len(files) // (4 * n_jobs))
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            beams = list(executor.map(read_function, files, chunksize=chunksize))
+    else:
+        beams = [read_function(file) for file in files]
+
+    df_beams = beam_table(files, [header for _, header in beams])
+    # Grab needed meta data of obs from the first file
+    obs_meta_data = observation_meta_data(beams[0][1])
+
+    file_frames = []
+    for file_index, (columns, _) in enumerate(beams):
+        columns = dict(columns)
+        columns['file_index'] = np.full(len(columns['cand_id_in_file']), file_index, dtype=np.int32)
+        file_frames.append(pd.DataFrame(columns))
+
+    df_candidates = pd.concat(file_frames, ignore_index=True)
+    # Categorical column of the file names, which only stores a code per candidate
+    df_candidates['file'] = df_beams['file'].values.take(df_candidates['file_index'].to_numpy())
 
     if verbose:
         print(f"{len(df_candidates)} candidates read.")
@@ -51,43 +74,130 @@ def read_candidate_files(files, verbose=True):
     df_candidates.sort_values('snr', inplace=True, ascending=False)
     df_candidates.reset_index(inplace=True, drop=True)
 
-    return df_candidates, obs_meta_data
-
+    return df_candidates, df_beams, obs_meta_data
 
-def create_row(root, candidates, file, file_index):
-    # Read a candidate file and creates data rows
 
-    src_raj = float(root[1].find("src_raj").text)
-    src_dej = float(root[1].find("src_dej").text)
+def beam_table(files, headers):
+    # Table with the file name and the position of each beam, one row per file_index
+    # Convert the positions of all beams at once
+    src_raj = np.array([float(header["src_raj"]) for header in headers])
+    src_dej = np.array([float(header["src_dej"]) for header in headers])
     src_rajd, src_dejd = convert_to_deg(src_raj, src_dej)
-    rows = []
-
-    # Enter attributes that should be ignored here
-    ignored_entries = ['candidate']
-    #ignored_entries = ['candidate', 'byte_offset', 'opt_period', 'folded_snr']
-    for candidate in candidates:
-        new_dict = {}
-        for can_entry in candidate.iter():
-            if not can_entry.tag in ignored_entries:
-                new_dict[can_entry.tag] = can_entry.text
-        cand_id = candidate.attrib.get("id")
-        new_dict['cand_id_in_file'] = cand_id
-        new_dict['src_raj'] = src_raj
-        new_dict['src_rajd'] = src_rajd
-        new_dict['src_dej'] = src_dej
-        new_dict['src_dejd'] = src_dejd
-        new_dict['file_index'] = file_index
-        new_dict['file'] = file
-        rows.append(new_dict)
-    return rows
+    file_names, file_codes = np.unique(np.array(files, dtype=str), return_inverse=True)
+    return pd.DataFrame({'file_index': np.arange(len(files), dtype=np.int32),
+                         'file': pd.Categorical.from_codes(file_codes, file_names),
+                         'src_raj': src_raj,
+                         'src_rajd': src_rajd,
+                         'src_dej': src_dej,
+                         'src_dejd': src_dejd})
+
+
+def observation_meta_data(header):
+    # Meta data of the observation from the header of a candidate file
+    # Maybe should grab all values and check if comparison between files makes sense
+    tsamp = float(header["tsamp"])
+    nsamples = float(header["nsamples"])
+    obs_length = tsamp * nsamples
+    speed_of_light = 299792458.0
+    obs_length_over_c = obs_length / speed_of_light
+    return {"tsamp": tsamp,
+            "nsamples": nsamples,
+            "obs_length": obs_length,
+            'obs_length_over_c': obs_length_over_c}
+
+
+def read_beam(file, tags=column_types):
+    # Parse a single candidate file incrementally
+    # Returns the candidate entries in tags as typed arrays and the header entries
+
+    header = {}
+    columns = {}
+    cand_ids = []
+    depth = 0
+    section_index = -1
+    for event, element in ET.iterparse(file, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 2:
+                section_index += 1
+                section = element
+            continue
+
+        if depth == 3 and section_index == header_section:
+            header[element.tag] = element.text
+        elif depth == 3 and section_index == candidate_section:
+            n_rows = len(cand_ids)
+            for can_entry in element.iter():
+                if can_entry.tag in tags:
+                    columns.setdefault(can_entry.tag, [None] * n_rows).append(
+                        can_entry.text)
+            cand_ids.append(element.attrib.get("id"))
+            # Pad entries missing in this candidate
+            for values in columns.values():
+                if len(values) == n_rows:
+                    values.append(None)
+            # Release the parsed candidate
+            element.clear()
+            section.remove(element)
+        elif depth == 2:
+            element.clear()
+        depth -= 1
+
+    # Every beam has all columns with the same types, also when it has no candidates
+    columns = {tag: typed_column(columns.get(tag, [None] * len(cand_ids)), tags[tag], tag, file)
+               for tag in tags}
+    columns['cand_id_in_file'] = typed_column(cand_ids, np.int32, 'id', file)
+    return columns, header
+
+
+def typed_column(values, dtype, tag, file):
+    # Convert the parsed entries of a tag, None marks entries missing in a candidate
+    if None in values:
+        if tag in required_tags:
+            raise ValueError(f"Candidates in {file} have no {tag}.")
+        missing_value = -1 if np.issubdtype(dtype, np.integer) else np.nan
+        values = [missing_value if value is None else value for value in values]
+    return np.array(values, dtype=dtype)
+
+
+def read_beam_cached(file, cache_dir, rebuild=False):
+    # Load a beam from the cache or parse and cache it
+    if not rebuild:
+        cached_beam = cand_cache.load_beam(cache_dir, file)
+        if cached_beam is not None:
+            return cached_beam
+    columns, header = read_beam(file)
+    cand_cache.save_beam(cache_dir, file, columns, header)
+    return columns, header
+
+
+def join_beam_columns(df_cands, df_beams):
+    # Add the positions of the beams to the candidates, e.g. for the output files
+    # The columns are placed before file_index like in the candidate files
+    rows = pd.Index(df_beams['file_index']).get_indexer(df_cands['file_index'])
+    df_joined = df_cands.copy()
+    insert_position = df_joined.columns.get_loc('file_index')
+    for column in reversed(beam_columns[2:]):
+        df_joined.insert(insert_position, column, df_beams[column].to_numpy()[rows])
+    return df_joined
 
 
 def convert_to_deg(ra, dec):
-    # Convert hour angle strings to degrees
-
-    ra_string = str(ra)
-    ra_string = ra_string[:2] + ' ' + ra_string[2:4] + ' ' + ra_string[4:]
-    dec_string = str(dec)
-    dec_string = dec_string[:3] + ' ' + dec_string[3:5] + ' ' + dec_string[5:]
-    coord = SkyCoord(ra_string + ' ' + dec_string, unit=(u.hourangle, u.deg))
-    return coord.ra.deg, coord.dec.deg
+    # Convert packed hour angle values (hhmmss.s and ddmmss.s) to degrees
+    # Works on single values and arrays
+
+    ra = np.asarray(ra, dtype=float)
+    ra_hours = ra // 10000
+    ra_minutes = ra // 100 % 100
+    ra_seconds = ra % 100
+    ra_deg = 15 * (ra_hours + ra_minutes / 60 + ra_seconds / 3600)
+
+    dec = np.asarray(dec, dtype=float)
+    # copysign keeps the sign of declinations between -1 and 0 degrees (-0.0)
+    dec_sign = np.copysign(1, dec)
+    dec = np.abs(dec)
+    dec_degrees = dec // 10000
+    dec_minutes = dec // 100 % 100
+    dec_seconds = dec % 100
+    dec_deg = dec_sign * (dec_degrees + dec_minutes / 60 + dec_seconds / 3600)
+    return ra_deg, dec_deg
@@ -1,176 +1,437 @@
 import numpy as np
-import math
-from sklearn.metrics import pairwise_distances
+import warnings
+from concurrent.futures import ProcessPoolExecutor
 from scipy.optimize import curve_fit
+from scipy.spatial import ConvexHull, QhullError, cKDTree
 import pandas as pd
-import os
-import matplotlib.pyplot as plt
-
-
-def angular_distance(degree_1, degree_2):
-    # Calculate angular distance in arcminutes
-    if not (degree_1 == degree_2).all():
-        degree_1_rad = degree_1 / 360 * 2 * math.pi
-        degree_2_rad = degree_2 / 360 * 2 * math.pi
-        angular_distance_rad = math.acos(math.sin(degree_1[1]) * math.sin(degree_2[1]) + math.cos(
-            degree_1[1]) * math.cos(degree_2[1]) * math.cos(degree_1[0] - degree_2[0]))
-        angular_distance_arcmin = angular_distance_rad * \
-            360 / (2 * math.pi) * 60
-    else:
-        angular_distance_arcmin = 0
-    return angular_distance_arcmin
+
+
+# Clusters with up to this many beam positions compare all pairs of positions,
+# larger clusters use a KD-tree and a convex hull to find the extent
+max_beams_all_pairs = 16
+
+# Beams closer than this factor times the typical distance to the nearest beam
+# are adjacent, which selects the first ring of a hexagonal tiling
+neighbour_spacing_factor = 1.5
+
+
+def angular_distance(ra_deg, dec_deg, ra_deg_2, dec_deg_2):
+    # Calculate angular distances in arcminutes between pairs of positions
+    # Uses the haversine formula which is stable for small distances
+    ra_rad = np.radians(ra_deg)
+    dec_rad = np.radians(dec_deg)
+    ra_rad_2 = np.radians(ra_deg_2)
+    dec_rad_2 = np.radians(dec_deg_2)
+    haversine = np.sin((dec_rad - dec_rad_2) / 2) ** 2 + \
+        np.cos(dec_rad) * np.cos(dec_rad_2) * np.sin((ra_rad - ra_rad_2) / 2) ** 2
+    angular_distance_rad = 2 * np.arcsin(np.sqrt(np.clip(haversine, 0, 1)))
+    return np.degrees(angular_distance_rad) * 60
+
+
+def angular_distance_matrix(ra_deg, dec_deg, ra_deg_2=None, dec_deg_2=None):
+    # Calculate angular distances in arcminutes between all positions
+    # or between the first and the second set of positions
+    if ra_deg_2 is None:
+        ra_deg_2, dec_deg_2 = ra_deg, dec_deg
+    return angular_distance(np.asarray(ra_deg)[:, np.newaxis], np.asarray(dec_deg)[:, np.newaxis],
+                            np.asarray(ra_deg_2)[np.newaxis, :],
+                            np.asarray(dec_deg_2)[np.newaxis, :])
+
+
+def beam_positions(df_beams):
+    # Unique beam positions in degrees and the row of the position for each file_index
+    positions, position_index = np.unique(
+        df_beams[['src_rajd', 'src_dejd']].values, axis=0, return_inverse=True)
+    file_position = pd.Series(position_index.ravel(),
+                              index=df_beams['file_index'].values)
+    return positions, file_position
+
+
+def unit_vectors(ra_deg, dec_deg):
+    # Positions on the unit sphere, the chord length increases with the angular distance
+    ra_rad = np.radians(ra_deg)
+    dec_rad = np.radians(dec_deg)
+    return np.column_stack([np.cos(dec_rad) * np.cos(ra_rad),
+                            np.cos(dec_rad) * np.sin(ra_rad),
+                            np.sin(dec_rad)])
+
+
+def gnomonic_projection(ra_deg, dec_deg, ra_centre, dec_centre):
+    # Project positions onto the tangent plane at the centre
+    # Great circles become straight lines, so the convex hull in the plane contains
+    # the positions furthest apart on the sphere. Needs positions within 90 degrees.
+    ra_rad = np.radians(ra_deg - ra_centre)
+    dec_rad = np.radians(dec_deg)
+    dec_centre_rad = np.radians(dec_centre)
+    cos_distance = np.sin(dec_centre_rad) * np.sin(dec_rad) + \
+        np.cos(dec_centre_rad) * np.cos(dec_rad) * np.cos(ra_rad)
+    x_vals = np.cos(dec_rad) * np.sin(ra_rad) / cos_distance
+    y_vals = (np.cos(dec_centre_rad) * np.sin(dec_rad) -
+              np.sin(dec_centre_rad) * np.cos(dec_rad) * np.cos(ra_rad)) / cos_distance
+    return np.column_stack([x_vals, y_vals])
+
+
+def extent_candidates(ra_deg, dec_deg):
+    # Positions which can be the furthest apart, the vertices of the convex hull
+    projected = gnomonic_projection(ra_deg, dec_deg, ra_deg[0], dec_deg[0])
+    try:
+        return ConvexHull(projected).vertices
+    except QhullError:
+        # All positions on a line, the ends of the line are the extremes in x or y
+        return np.unique([projected[:, 0].argmin(), projected[:, 0].argmax(),
+                          projected[:, 1].argmin(), projected[:, 1].argmax()])
+
+
+def cluster_extent(ra_deg, dec_deg):
+    # Largest and smallest distance between the unique positions of a cluster
+    # Small clusters compare all pairs, larger ones only compare the vertices of the
+    # convex hull for the largest distance and use the nearest neighbours for the smallest
+    n_positions = len(ra_deg)
+    if n_positions < 2:
+        return np.nan, np.nan
+    if n_positions <= max_beams_all_pairs:
+        distances = angular_distance_matrix(ra_deg, dec_deg)
+        return distances.max(), distances[distances > 0].min()
+
+    vertices = extent_candidates(ra_deg, dec_deg)
+    max_distance = angular_distance_matrix(ra_deg[vertices], dec_deg[vertices]).max()
+    vectors = unit_vectors(ra_deg, dec_deg)
+    _, nearest = cKDTree(vectors).query(vectors, k=2)
+    min_distance = angular_distance(ra_deg, dec_deg, ra_deg[nearest[:, 1]],
+                                    dec_deg[nearest[:, 1]]).min()
+    return max_distance, min_distance
+
+
+def beam_adjacency(positions):
+    # Adjacent beams of each unique position, built once for the whole tiling
+    # Returns the neighbours of all positions and the start of each position in them
+    n_positions = len(positions)
+    if n_positions < 2:
+        return np.zeros(n_positions + 1, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    vectors = unit_vectors(positions[:, 0], positions[:, 1])
+    tree = cKDTree(vectors)
+    nearest_chords, _ = tree.query(vectors, k=2)
+    spacing = np.median(nearest_chords[:, 1])
+    pairs = tree.query_pairs(neighbour_spacing_factor * spacing, output_type='ndarray')
+
+    # Both directions of each pair, grouped by the first position
+    first = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    second = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    order = np.argsort(first, kind='stable')
+    neighbour_starts = np.concatenate([[0], np.cumsum(np.bincount(first, minlength=n_positions))])
+    return neighbour_starts, second[order]
+
+
+def neighbour_fraction(adjacency, max_rows, beam_clusters, beam_rows, n_positions):
+    # Fraction of the beams adjacent to the beam with the highest snr which also detect
+    # the cluster, nan when that beam has no neighbours
+    # max_rows is the position of the highest snr of each cluster, beam_clusters and
+    # beam_rows give the cluster and the position of each detection
+    neighbour_starts, neighbours = adjacency
+    n_clusters = len(max_rows)
+    n_neighbours = neighbour_starts[max_rows + 1] - neighbour_starts[max_rows]
+
+    # All pairs of cluster and neighbour, compared with all pairs of cluster and beam
+    pair_clusters = np.repeat(np.arange(n_clusters), n_neighbours)
+    offsets = np.arange(n_neighbours.sum()) - np.repeat(np.cumsum(n_neighbours) - n_neighbours,
+                                                        n_neighbours)
+    pair_rows = neighbours[np.repeat(neighbour_starts[max_rows], n_neighbours) + offsets]
+    detected = np.isin(pair_clusters * n_positions + pair_rows,
+                       beam_clusters * n_positions + beam_rows)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.bincount(pair_clusters, weights=detected, minlength=n_clusters) / n_neighbours
 
 
 def decay_law(x, a, b):
     return a * np.exp(-b * x)
 
 
-def fit_decay(x_vals, y_vals):
+# curve_fit: nonlinear fit starting at a=max(snr), b=0.01
+# loglinear: closed form weighted least squares fit of log(snr)
+# loglinear_refine: nonlinear fit starting at the loglinear result
+fit_methods = ['curve_fit', 'loglinear', 'loglinear_refine']
+
+fit_columns = ['fit_amplitude', 'fit_amplitude_error', 'fit_decay', 'fit_decay_error',
+               'fit_status', 'fit_message']
+
+
+def fit_decay(x_vals, y_vals, p0=None):
     # ,method='trf',loss='arctan')
-    popt, pcov = curve_fit(decay_law, x_vals, y_vals, p0=[y_vals.max(), 0.01])
+    if p0 is None:
+        p0 = [y_vals.max(), 0.01]
+    popt, pcov = curve_fit(decay_law, x_vals, y_vals, p0=p0)
     errors = np.sqrt(np.diag(pcov))
     return popt, errors
 
 
-def label_spatial_rfi(df_cands, config, plot_arguments=[False, '']):
-    # Determine if the clusters show RFI like behaviour spatially
+def fit_decay_loglinear(x_vals, y_vals, group_index, n_groups):
+    # Fit log(y) = log(a) - b * x for many groups of values at once
+    # The weights y**2 account for the variance of log(y) scaling with 1 / y**2
+    # group_index gives the group of each value, returns arrays for all groups
+    log_y = np.log(y_vals)
+    weights = y_vals ** 2
 
-    # Count size oif cluster and order them, could be later be replaced
-    # when DataFrame containing the data about the cluster is created
-    unique, counts = np.unique(df_cands['cluster_id'], return_counts=True)
-    count_sort_ind = np.argsort(-counts)
-    unique = unique[count_sort_ind]
-    counts = counts[count_sort_ind]
+    def group_sum(values):
+        return np.bincount(group_index, weights=values, minlength=n_groups)
 
-    if plot_arguments[0]:
+    n_vals = np.bincount(group_index, minlength=n_groups)
+    sum_w = group_sum(weights)
+    sum_wx = group_sum(weights * x_vals)
+    sum_wxx = group_sum(weights * x_vals ** 2)
+    sum_wy = group_sum(weights * log_y)
+    sum_wxy = group_sum(weights * x_vals * log_y)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        determinant = sum_w * sum_wxx - sum_wx ** 2
+        log_amplitude = (sum_wxx * sum_wy - sum_wx * sum_wxy) / determinant
+        decay = (sum_wx * sum_wy - sum_w * sum_wxy) / determinant
+
+        residuals = log_y - log_amplitude[group_index] + decay[group_index] * x_vals
+        variance = group_sum(weights * residuals ** 2) / (n_vals - 2)
+        log_amplitude_error = np.sqrt(sum_wxx / determinant * variance)
+        decay_error = np.sqrt(sum_w / determinant * variance)
+
+    amplitude = np.exp(log_amplitude)
+    amplitude_error = amplitude * log_amplitude_error
+    return amplitude, amplitude_error, decay, decay_error
+
+
+def fit_status(parameters, errors):
+    # Describe the result of a single fit
+    if not np.all(np.isfinite(parameters)):
+        return 'failed', 'Fit did not converge'
+    if not np.all(np.isfinite(errors)):
+        return 'no_covariance', 'Covariance could not be estimated'
+    return 'ok', ''
+
+
+def fit_decay_nonlinear(x_vals, y_vals, p0=None):
+    # Nonlinear fit of a single cluster, failures are described in the result
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
         try:
-            os.mkdir(plot_arguments[1])
-        except FileExistsError:
-            pass
+            parameters, errors = fit_decay(x_vals, y_vals, p0=p0)
+        except (RuntimeError, ValueError, TypeError, np.linalg.LinAlgError) as error:
+            return [np.nan, np.nan, np.nan, np.nan, 'failed', str(error)]
+    return [parameters[0], errors[0], parameters[1], errors[1], *fit_status(parameters, errors)]
+
+
+def fit_decay_nonlinear_chunk(fit_inputs):
+    # Nonlinear fits of a list of (x_vals, y_vals, p0) tuples
+    return [fit_decay_nonlinear(*fit_input) for fit_input in fit_inputs]
 
-    # Create list that contains the new cluster DataFrame
+
+def fit_clusters(x_vals_list, y_vals_list, method='curve_fit', n_jobs=1):
+    # Fit the exponential decay for all clusters
+    # Returns a DataFrame with one row per cluster and the columns in fit_columns
+    if method not in fit_methods:
+        raise ValueError(f"Unknown fit_method {method}, options are {fit_methods}")
+
+    n_groups = len(x_vals_list)
+    if n_groups == 0:
+        return pd.DataFrame([], columns=fit_columns)
+
+    if method in ['loglinear', 'loglinear_refine']:
+        group_index = np.repeat(np.arange(n_groups), [len(x) for x in x_vals_list])
+        fit_values = fit_decay_loglinear(np.concatenate(x_vals_list), np.concatenate(y_vals_list),
+                                         group_index, n_groups)
+        rows = []
+        for amplitude, amplitude_error, decay, decay_error in zip(*fit_values):
+            status = fit_status([amplitude, decay], [amplitude_error, decay_error])
+            rows.append([amplitude, amplitude_error, decay, decay_error, *status])
+        if method == 'loglinear':
+            return pd.DataFrame(rows, columns=fit_columns)
+        # Use the closed form result as starting value where it exists
+        p0_list = [[row[0], row[2]] if row[4] != 'failed' else None for row in rows]
+    else:
+        p0_list = [None] * n_groups
+
+    fit_inputs = list(zip(x_vals_list, y_vals_list, p0_list))
+    if n_jobs > 1 and n_groups > 1:
+        n_chunks = min(n_groups, 4 * n_jobs)
+        chunks = [fit_inputs[chunk_index::n_chunks] for chunk_index in range(n_chunks)]
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            chunk_results = list(executor.map(fit_decay_nonlinear_chunk, chunks))
+        # Restore the original order of the strided chunks
+        rows = [None] * n_groups
+        for chunk_index, chunk_rows in enumerate(chunk_results):
+            rows[chunk_index::n_chunks] = chunk_rows
+    else:
+        rows = fit_decay_nonlinear_chunk(fit_inputs)
+    return pd.DataFrame(rows, columns=fit_columns)
+
+
+# Values aggregated over all candidates of a cluster
+cluster_aggregations = {'cluster_size': ('snr', 'size'),
+                        'max_snr': ('snr', 'max'),
+                        'min_snr': ('snr', 'min'),
+                        'max_dm': ('dm', 'max'),
+                        'min_dm': ('dm', 'min'),
+                        'max_period': ('period', 'max'),
+                        'min_period': ('period', 'min'),
+                        'nassoc_sum': ('nassoc', 'sum')}
+
+# How the aggregated values of parts of a cluster are combined
+combined_aggregations = {'cluster_size': 'sum', 'max_snr': 'max', 'min_snr': 'min',
+                         'max_dm': 'max', 'min_dm': 'min', 'max_period': 'max',
+                         'min_period': 'min', 'nassoc_sum': 'sum'}
+
+
+def aggregate_clusters(df_cands):
+    # Aggregated values of the clusters in df_cands, indexed by cluster_id
+    return df_cands.groupby('cluster_id', sort=False).agg(**cluster_aggregations)
+
+
+def combine_aggregates(aggregates):
+    # Combine the aggregated values of parts of the candidates, e.g. of several chunks
+    return pd.concat(aggregates).groupby(level=0, sort=False).agg(combined_aggregations)
+
+
+# Values of the strongest candidate of a cluster which are used in the cluster list
+best_candidate_columns = ['cluster_id', 'file_index', 'file', 'snr', 'period', 'acc', 'dm']
+
+
+def best_candidate_rows(df_cands):
+    # Strongest candidate of each cluster with the index of the candidate
+    # df_cands is sorted by snr, so the first candidate of a cluster is the best one
+    return df_cands.drop_duplicates('cluster_id')[best_candidate_columns]
+
+
+def combine_best_candidates(parts):
+    # Strongest candidate of each cluster from the best_candidate_rows of parts of the candidates
+    # Candidates with the same snr are ordered by their index
+    df_best = pd.concat(parts)
+    order = np.lexsort((df_best.index.to_numpy(), -df_best['snr'].to_numpy()))
+    return df_best.iloc[order].drop_duplicates('cluster_id')
+
+
+def cluster_statistics(df_cands, df_stats=None, df_best=None):
+    # Aggregate the basic values of all clusters
+    # df_stats from aggregate_clusters and df_best from best_candidate_rows can be given
+    # when df_cands does not contain all candidates, df_cands then needs the strongest
+    # candidate per beam of all clusters seen in more than one beam
+    if df_stats is None:
+        df_stats = aggregate_clusters(df_cands)
+    if df_best is None:
+        df_best = best_candidate_rows(df_cands)
+    # Clusters without candidates in df_cands are seen in a single beam
+    cluster_beams = df_cands.groupby('cluster_id', sort=False)['file_index'].nunique()
+    cluster_beams = cluster_beams.reindex(df_best['cluster_id'].to_numpy(), fill_value=1)
+
+    best_candidates = df_best.rename_axis('best_candidate_index').reset_index()
+    best_candidates = best_candidates.set_index('cluster_id', drop=False).rename_axis(None)
+
+    df_clusters = pd.DataFrame({
+        'cluster_id': best_candidates['cluster_id'],
+        'cluster_size': df_stats['cluster_size'],
+        'cluster_beams': cluster_beams,
+        'max_snr': df_stats['max_snr'],
+        'min_snr': df_stats['min_snr'],
+        'best_candidate_index': best_candidates['best_candidate_index'],
+        'best_candidate_file': best_candidates['file'],
+        'best_period': best_candidates['period'],
+        'best_acc': best_candidates['acc'],
+        'best_dm': best_candidates['dm'],
+        'max_dm': df_stats['max_dm'],
+        'min_dm': df_stats['min_dm'],
+        'period_range': df_stats['max_period'] - df_stats['min_period'],
+        'total_nassoc': df_stats['cluster_size'] + df_stats['nassoc_sum'],
+    })
+
+    # Begin with the largest cluster
+    df_clusters.sort_values(['cluster_size', 'cluster_id'], ascending=[False, True],
+                            inplace=True, kind='mergesort')
+    df_clusters.reset_index(inplace=True, drop=True)
+    return df_clusters
+
+
+def strongest_per_beam(df_cands):
+    # Strongest candidate of each cluster in each beam, grouped by cluster
+    # When the same beam is in multiple files this does not quite correctly
+    df_beams = df_cands.drop_duplicates(['cluster_id', 'file_index'])
+    return df_beams.sort_values('cluster_id', kind='mergesort')
+
+
+def label_spatial_rfi(df_cands, df_beams, config, n_jobs=1, df_stats=None, df_best=None):
+    # Determine if the clusters show RFI like behaviour spatially
+    # df_beams contains the position of each file_index
+    # df_stats and df_best are passed to cluster_statistics
+
+    if df_best is None:
+        df_best = best_candidate_rows(df_cands)
+    df_clusters = cluster_statistics(df_cands, df_stats, df_best)
+
+    # Positions of the beams, each cluster uses a subset
+    positions, file_position = beam_positions(df_beams)
+
+    # Strongest candidate per beam for all clusters, each cluster is one slice
+    df_beams_all = strongest_per_beam(df_cands)
+    beam_cluster_ids = df_beams_all['cluster_id'].values
+    beam_rows_all = file_position[df_beams_all['file_index'].values].values
+    snr_vals_all = df_beams_all['snr'].values
+    cluster_ids = df_clusters['cluster_id'].values
+    beam_starts = np.searchsorted(beam_cluster_ids, cluster_ids, side='left')
+    beam_stops = np.searchsorted(beam_cluster_ids, cluster_ids, side='right')
+
+    # Create list that contains the spatial values of the clusters
     rows = []
+    # Clusters that will be fitted, the values of the fit and the distances
+    fit_cluster_indices = []
+    fit_distances = []
+    fit_snr_vals = []
 
     # Cycle thorugh all clusters, beginning with the largest
-    for i in unique[:]:
-        # Create DataFrame with only the cluster candidates
-        df_truncated = df_cands[df_cands['cluster_id'] == i]
-
-        # First read out some basic values
-        best_candidate = df_truncated.iloc[0]
+    # Only the distances from the beam with the highest snr are calculated,
+    # so the time and memory per cluster grow linearly with the number of beams
+    for cluster_index in range(len(cluster_ids)):
+        beam_start = beam_starts[cluster_index]
+        beam_stop = beam_stops[cluster_index]
+        n_beams = beam_stop - beam_start
         new_row = {}
-        new_row['cluster_id'] = i
-        new_row['cluster_size'] = len(df_truncated)
-        new_row['cluster_beams'] = df_truncated['file_index'].nunique()
-        new_row['max_snr'] = df_truncated['snr'].max()
-        new_row['min_snr'] = df_truncated['snr'].min()
-        new_row['best_candidate_index'] = best_candidate.name
-        new_row['best_candidate_file'] = best_candidate['file']
-        new_row['best_period'] = best_candidate['period']
-        new_row['best_acc'] = best_candidate['acc']
-        new_row['best_dm'] = best_candidate['dm']
-        new_row['max_dm'] = df_truncated['dm'].max()
-        new_row['min_dm'] = df_truncated['dm'].min()
-        new_row['period_range'] = df_truncated['period'].max() - \
-            df_truncated['period'].min()
-
-        total_nassoc = len(df_truncated) + df_truncated['nassoc'].sum()
-
-        new_row['total_nassoc'] = total_nassoc
-
-        # Create DataFrame with only the strongest candidate per beam
-        unique_beams = df_truncated['file_index'].unique()
-        df_beams = pd.DataFrame([])
-        for beam in unique_beams:
-            # When the same beam is in multiple files this does not quite correctly
-            row = df_truncated[df_truncated['file_index'] == beam].iloc[0]
-            df_beams = df_beams.append(row, ignore_index=True)
-
-        # Fit an exponential decay to the maximum snr in each beam where a candidate is seen
-        coords = df_beams[['src_rajd', 'src_dejd']].values
-
-        if len(df_beams) > 1:
-
-            # Currently calculates all distances, not fast, but gives largest value
-            distances = pairwise_distances(coords, metric=angular_distance)
-
-            try:
-                max_distance = distances[distances > 0].max()
-                min_distance = distances[distances > 0].min()
-            except:
-                max_distance = np.nan
-                min_distance = np.nan
-            if len(df_beams) > config['min_size_cluster_for_fit']:
-                max_pos = df_beams['snr'].values.argmax()
-                distances_from_max = distances[max_pos, :]
-                snr_vals = df_beams['snr'].values
-                try:
-                    fit_parameters, fit_errors = fit_decay(
-                        distances_from_max, snr_vals)
-                except:
-                    fit_parameters, fit_errors = [
-                        np.nan, np.nan], [np.nan, np.nan]
-                fitted = True
-            else:
-                fit_parameters, fit_errors = [np.nan, np.nan], [np.nan, np.nan]
-                fitted = False
+
+        if n_beams > 1:
+            # Unique positions of the cluster, beginning with the position of the highest snr
+            beam_rows = beam_rows_all[beam_start:beam_stop]
+            snr_vals = snr_vals_all[beam_start:beam_stop]
+            max_row = beam_rows[snr_vals.argmax()]
+            cluster_rows = np.unique(beam_rows)
+            cluster_rows = np.concatenate([[max_row], cluster_rows[cluster_rows != max_row]])
+            max_distance, min_distance = cluster_extent(positions[cluster_rows, 0],
+                                                        positions[cluster_rows, 1])
+            if n_beams > config['min_size_cluster_for_fit']:
+                fit_cluster_indices.append(cluster_index)
+                fit_distances.append(angular_distance(
+                    positions[max_row, 0], positions[max_row, 1],
+                    positions[beam_rows, 0], positions[beam_rows, 1]))
+                fit_snr_vals.append(snr_vals)
         else:
             max_distance = np.nan
             min_distance = np.nan
-            fitted = False
 
         new_row['max_distance'] = max_distance
         new_row['min_distance'] = min_distance
-        new_row['fit_decay'] = fit_parameters[1]
-        new_row['fit_decay_error'] = fit_errors[1]
-        new_row['fit_amplitude'] = fit_parameters[0]
-        new_row['fit_amplitude_error'] = fit_errors[0]
-
         rows.append(new_row)
 
-        if plot_arguments[0] and fitted:
-            # Plot diagnostic plots
-            fig, (ax1, ax2, ax3, ax4) = plt.subplots(1, 4, figsize=(25, 4))
-
-            ax1.scatter(df_beams['src_rajd'],
-                        df_beams['src_dejd'], s=df_beams['snr'] * 1.5)
-            ax1.set_xlim(df_cands['src_rajd'].min() - 0.01,
-                         df_cands['src_rajd'].max() + 0.01)
-            ax1.set_ylim(df_cands['src_dejd'].min() - 0.01,
-                         df_cands['src_dejd'].max() + 0.01)
-            ax1.set(xlabel='src_rajd', ylabel='src_dejd')
-            ax1.set_title(f"{new_row['cluster_size']} candidates in {new_row['cluster_beams']} beams")
-
-            if len(snr_vals) > 3:
-                new_xvals = np.linspace(0, distances_from_max.max(), 20)
-                new_yvals = decay_law(new_xvals, *fit_parameters)
-                ax2.plot(new_xvals, new_yvals)
-            ax2.scatter(distances_from_max, snr_vals)
-            ax2.set_title(f"a*exp(-b*x); b={fit_parameters[1]}")
-            ax2.set(xlabel='Distance (´)', ylabel='snr')
-
-            ax3.scatter(df_cands['period'], df_cands['acc'],
-                        s=df_cands['snr'] * 2, c='r')
-            ax3.scatter(
-                df_truncated['period'], df_truncated['acc'], s=df_truncated['snr'] * 2)
-            border = (df_truncated['period'].max() -
-                      df_truncated['period'].min()) * 0.1
-            if border == 0:
-                border = new_row['best_period'] * 0.02
-            ax3.set_xlim(df_truncated['period'].min(
-            ) - border, df_truncated['period'].max() + border)
-            ax3.set(xlabel='period', ylabel='acc')
-            ax3.set_title(f"P0:  {new_row['best_period']}; Range: {new_row['period_range']}")
-
-            ax4.scatter(df_truncated['period'],
-                        df_truncated['dm'], s=df_truncated['snr'] * 2)
-            ax4.set_xlim(df_truncated['period'].min(
-            ) - border, df_truncated['period'].max() + border)
-            ax4.set(xlabel='period', ylabel='DM')
-            ax4.set_title(f"DM: {new_row['min_dm']} - {new_row['max_dm']}")
-
-            plt.savefig(f"{plot_arguments[1]}cluster_{i}_Size_{new_row['cluster_size']}_P0_{new_row['best_period']}.png",
-                        bbox_inches='tight')
-    df_clusters = pd.DataFrame(rows)
+    df_spatial = pd.DataFrame(rows)
+    if config.get('neighbour_metric', False):
+        # The strongest candidate of a cluster is in the beam with the highest snr
+        max_files = df_best.set_index('cluster_id')['file_index'].reindex(cluster_ids)
+        df_spatial['neighbour_fraction'] = neighbour_fraction(
+            beam_adjacency(positions), file_position[max_files.to_numpy()].to_numpy(),
+            pd.Index(cluster_ids).get_indexer(beam_cluster_ids), beam_rows_all, len(positions))
+
+    # Fit an exponential decay to the maximum snr in each beam where a candidate is seen
+    df_fits = fit_clusters(fit_distances, fit_snr_vals,
+                           method=config.get('fit_method', 'curve_fit'), n_jobs=n_jobs)
+    df_fits.index = fit_cluster_indices
+    df_fits = df_fits.reindex(range(len(cluster_ids)))
+    df_fits['fit_status'] = df_fits['fit_status'].fillna('not_fitted')
+    df_fits['fit_message'] = df_fits['fit_message'].fillna('')
+
+    df_clusters = pd.concat([df_clusters, df_spatial,
+                             df_fits[['fit_decay', 'fit_decay_error', 'fit_amplitude',
+                                      'fit_amplitude_error', 'fit_status', 'fit_message']]],
+                            axis=1)
 
     return df_clusters
@@ -0,0 +1,217 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+
+speed_of_light = 299792458.0
+
+# Root sections of the overview.xml files, the header has to be the second and the
+# candidates the seventh section, see reading_cands
+root_sections = ['misc_info', 'header_parameters', 'search_parameters', 'segment_parameters',
+                 'dedispersion_trials', 'acceleration_trials', 'candidates', 'execution_times']
+
+
+def parse_arguments():
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(
+        description='Create overview.xml files of a synthetic multi-beam pointing.')
+    parser.add_argument('-o', '--output', type=str, required=True, metavar=('output_folder'),
+                        help="Folder in which the beam folders are created.")
+    parser.add_argument('-b', '--beams', type=int, default=100,
+                        help="Number of beams.")
+    parser.add_argument('-n', '--candidates', type=int, default=10000,
+                        help="Approximate total number of candidates.")
+    parser.add_argument('--pulsars', type=int, default=None,
+                        help="Number of pulsars. Scales with the candidates by default.")
+    parser.add_argument('--rfi', type=int, default=None,
+                        help="Number of spatial RFI signals. Scales with the candidates by default.")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Seed of the random number generator.")
+    args = parser.parse_args()
+    return args
+
+
+def hexagonal_tiling(n_beams, spacing):
+    # Offsets in arcminutes of a hexagonal beam tiling around the centre
+    offsets = [(0., 0.)]
+    ring = 1
+    while len(offsets) < n_beams:
+        for side in range(6):
+            corner_angle = np.pi / 3 * side
+            next_angle = np.pi / 3 * (side + 1)
+            for step in range(ring):
+                x = ring * np.cos(corner_angle) + step * (np.cos(next_angle) - np.cos(corner_angle))
+                y = ring * np.sin(corner_angle) + step * (np.sin(next_angle) - np.sin(corner_angle))
+                offsets.append((x * spacing, y * spacing))
+        ring += 1
+    return np.array(offsets[:n_beams])
+
+
+def pack_hour_angle(ra_deg, dec_deg):
+    # Convert degrees to the packed values used in src_raj (hhmmss.s) and src_dej (ddmmss.s)
+    ra_seconds = np.round(ra_deg / 15 * 3600, 4)
+    ra_packed = ra_seconds // 3600 * 10000 + ra_seconds % 3600 // 60 * 100 + ra_seconds % 60
+    dec_seconds = np.round(np.abs(dec_deg) * 3600, 4)
+    dec_packed = dec_seconds // 3600 * 10000 + dec_seconds % 3600 // 60 * 100 + dec_seconds % 60
+    return ra_packed, np.copysign(dec_packed, dec_deg)
+
+
+def smeared_periods(period, delta_acc, obs_length, rng):
+    # Periods of acceleration smeared duplicates, which lie inside the period range
+    # that the clustering considers related (see cluster_cands.acc_upper_range)
+    return period / (1 - rng.uniform(0, 1, len(delta_acc)) * np.abs(delta_acc) * obs_length / speed_of_light)
+
+
+def pulsar_candidates(beam_ra, beam_dec, obs_length, n_pulsars, beam_width, rng):
+    # Pulsars with a snr that decays with the distance from their position
+    rows = []
+    for pulsar_index in range(n_pulsars):
+        period = 10 ** rng.uniform(-2.7, 0.3)
+        dm = rng.uniform(5, 500)
+        acc = rng.normal(0, 5)
+        peak_snr = 10 ** rng.uniform(0.9, 2.3)
+        beam = rng.integers(len(beam_ra))
+        ra = beam_ra[beam] + rng.normal(0, beam_width / 2) / 60 / np.cos(np.radians(beam_dec[beam]))
+        dec = beam_dec[beam] + rng.normal(0, beam_width / 2) / 60
+
+        distance = np.hypot((beam_ra - ra) * np.cos(np.radians(dec)), beam_dec - dec) * 60
+        snr = peak_snr * np.exp(-4 * np.log(2) * (distance / beam_width) ** 2)
+        for beam_index in np.flatnonzero(snr > 7):
+            n_dup = rng.poisson(2)
+            delta_acc = np.concatenate([[0], rng.uniform(-30, 30, n_dup)])
+            periods = smeared_periods(period, delta_acc, obs_length, rng)
+            for dup_index in range(n_dup + 1):
+                rows.append({'file_index': beam_index,
+                             'period': periods[dup_index] * (1 + rng.normal(0, 1e-7)),
+                             'dm': dm + rng.normal(0, 0.5),
+                             'acc': acc + delta_acc[dup_index],
+                             'snr': snr[beam_index] * (1 if dup_index == 0 else rng.uniform(0.5, 0.9)),
+                             'nassoc': rng.poisson(4),
+                             'source': f"pulsar_{pulsar_index}"})
+    return rows
+
+
+def rfi_candidates(n_beams, obs_length, n_rfi, rng):
+    # Broadband RFI which is seen with similar snr in most beams over a wide DM range
+    rows = []
+    for rfi_index in range(n_rfi):
+        period = 1 / 50 * rng.integers(1, 20) if rng.uniform() < 0.5 else 10 ** rng.uniform(-2, 0)
+        snr_level = rng.uniform(8, 20)
+        detected = np.flatnonzero(rng.uniform(0, 1, n_beams) < rng.uniform(0.6, 1))
+        for beam_index in detected:
+            n_dm = rng.integers(2, 8)
+            delta_acc = rng.uniform(-20, 20, n_dm)
+            periods = smeared_periods(period, delta_acc, obs_length, rng)
+            dms = np.sort(rng.uniform(0, 30, n_dm))
+            for dm_index in range(n_dm):
+                rows.append({'file_index': beam_index,
+                             'period': periods[dm_index],
+                             'dm': dms[dm_index],
+                             'acc': delta_acc[dm_index],
+                             'snr': snr_level * rng.uniform(0.9, 1.1),
+                             'nassoc': rng.poisson(2),
+                             'source': f"rfi_{rfi_index}"})
+    return rows
+
+
+def noise_candidates(n_beams, n_noise, rng):
+    # Unrelated candidates close to the detection threshold
+    return pd.DataFrame({'file_index': rng.integers(n_beams, size=n_noise),
+                         'period': 10 ** rng.uniform(-3, 1, n_noise),
+                         'dm': rng.uniform(0, 1000, n_noise),
+                         'acc': rng.uniform(-100, 100, n_noise),
+                         'snr': 6 + rng.exponential(1, n_noise),
+                         'nassoc': rng.poisson(0.5, n_noise),
+                         'source': 'noise'})
+
+
+def write_overview(file, src_raj, src_dej, tsamp, nsamples, df_beam):
+    # Write a single beam in the layout of the peasoup overview.xml files
+    lines = ["<?xml version='1.0' encoding='ISO-8859-1'?>", "<peasoup_search>"]
+    for section in root_sections:
+        if section == 'header_parameters':
+            lines.append(f"<{section}>")
+            lines.append(f"<src_raj>{src_raj:.4f}</src_raj>")
+            lines.append(f"<src_dej>{src_dej:.4f}</src_dej>")
+            lines.append(f"<tsamp>{tsamp}</tsamp>")
+            lines.append(f"<nsamples>{nsamples}</nsamples>")
+            lines.append(f"</{section}>")
+        elif section == 'candidates':
+            lines.append(f"<{section}>")
+            for cand_index, cand in enumerate(df_beam.itertuples(index=False)):
+                lines.append(f"<candidate id='{cand_index}'>")
+                lines.append(f"<period>{cand.period:.12f}</period>")
+                lines.append(f"<opt_period>{cand.period:.12f}</opt_period>")
+                lines.append(f"<dm>{cand.dm:.6f}</dm>")
+                lines.append(f"<acc>{cand.acc:.6f}</acc>")
+                lines.append("<nh>2</nh>")
+                lines.append(f"<snr>{cand.snr:.6f}</snr>")
+                lines.append(f"<folded_snr>{cand.snr:.6f}</folded_snr>")
+                lines.append("<is_adjacent>0</is_adjacent>")
+                lines.append("<is_physical>1</is_physical>")
+                lines.append("<ddm_count_ratio>0</ddm_count_ratio>")
+                lines.append("<ddm_snr_ratio>0</ddm_snr_ratio>")
+                lines.append(f"<nassoc>{cand.nassoc}</nassoc>")
+                lines.append(f"<byte_offset>{cand_index * 1024}</byte_offset>")
+                lines.append("</candidate>")
+            lines.append(f"</{section}>")
+        else:
+            lines.append(f"<{section}></{section}>")
+    lines.append("</peasoup_search>")
+
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    with open(file, 'w') as xml_file:
+        xml_file.write('\n'.join(lines))
+
+
+def generate_pointing(output_folder, n_beams=100, n_candidates=10000, n_pulsars=None,
+                      n_rfi=None, seed=0, beam_spacing=1.5, tsamp=6.4e-05, nsamples=2 ** 23,
+                      centre=(270., -30.)):
+    # Create the overview.xml files of a synthetic pointing
+    # Returns the list of files and a DataFrame describing every written candidate
+    rng = np.random.default_rng(seed)
+    obs_length = tsamp * nsamples
+    if n_pulsars is None:
+        n_pulsars = max(1, n_candidates // 2000)
+    if n_rfi is None:
+        n_rfi = max(1, n_candidates // 5000)
+
+    offsets = hexagonal_tiling(n_beams, beam_spacing)
+    beam_dec = centre[1] + offsets[:, 1] / 60
+    beam_ra = centre[0] + offsets[:, 0] / 60 / np.cos(np.radians(beam_dec))
+    src_raj, src_dej = pack_hour_angle(beam_ra, beam_dec)
+
+    df_signals = pd.DataFrame(
+        pulsar_candidates(beam_ra, beam_dec, obs_length, n_pulsars, beam_spacing, rng) +
+        rfi_candidates(n_beams, obs_length, n_rfi, rng),
+        columns=['file_index', 'period', 'dm', 'acc', 'snr', 'nassoc', 'source'])
+    n_noise = max(0, n_candidates - len(df_signals))
+    df_truth = pd.concat([df_signals, noise_candidates(n_beams, n_noise, rng)],
+                         ignore_index=True)
+    # Candidates in the files are sorted by snr
+    df_truth.sort_values(['file_index', 'snr'], ascending=[True, False], inplace=True)
+    df_truth.reset_index(inplace=True, drop=True)
+
+    files = [os.path.join(output_folder, f"beam_{beam_index:04d}", 'overview.xml')
+             for beam_index in range(n_beams)]
+    df_truth['file'] = np.array(files)[df_truth['file_index']]
+    beam_groups = df_truth.groupby('file_index').indices
+    for beam_index, file in enumerate(files):
+        df_beam = df_truth.iloc[beam_groups.get(beam_index, [])]
+        write_overview(file, src_raj[beam_index], src_dej[beam_index], tsamp, nsamples, df_beam)
+
+    return files, df_truth
+
+
+def main(args):
+    files, df_truth = generate_pointing(args.output, n_beams=args.beams,
+                                        n_candidates=args.candidates, n_pulsars=args.pulsars,
+                                        n_rfi=args.rfi, seed=args.seed)
+    df_truth.to_csv(os.path.join(args.output, 'truth.csv'))
+    print(f"{len(df_truth)} candidates written to {len(files)} files.")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
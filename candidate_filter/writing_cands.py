@@ -0,0 +1,57 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Formats for the candidate lists of single beams
+# parquet and feather require pyarrow
+output_formats = ['csv', 'parquet', 'feather']
+
+
+def check_output_formats(formats):
+    # Fail before any file is written when a format can not be written
+    for output_format in formats:
+        if output_format not in output_formats:
+            raise ValueError(
+                f"Unknown output format {output_format}, options are {output_formats}")
+    if 'parquet' in formats or 'feather' in formats:
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("Writing parquet or feather files requires pyarrow.")
+
+
+def beam_name(file):
+    # Name of the output file of a beam, given by the folder of its candidate file
+    return os.path.basename(os.path.dirname(file))
+
+
+def write_beam(df_file, path, formats):
+    # Write the candidates of a single beam in all requested formats
+    for output_format in formats:
+        if output_format == 'csv':
+            df_file.to_csv(f"{path}.csv")
+        elif output_format == 'parquet':
+            df_file.to_parquet(f"{path}.parquet")
+        elif output_format == 'feather':
+            # Feather only stores a default index
+            df_file.reset_index().to_feather(f"{path}.feather")
+
+
+def write_single_beams(df_cands, output_folder, formats=['csv'], n_jobs=1):
+    # Write out candidate lists for single beams
+    # The DataFrame is split once and every beam file is written once
+    check_output_formats(formats)
+    os.makedirs(output_folder, exist_ok=True)
+
+    beams = []
+    for _, df_file in df_cands.groupby('file_index', sort=False):
+        path = os.path.join(output_folder, beam_name(df_file['file'].iloc[0]))
+        beams.append((df_file, path))
+
+    if n_jobs > 1 and len(beams) > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            # list() raises errors that happened during writing
+            list(executor.map(lambda beam: write_beam(*beam, formats), beams))
+    else:
+        for df_file, path in beams:
+            write_beam(df_file, path, formats)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of candidate_filter import each other by their module names
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'candidate_filter'))
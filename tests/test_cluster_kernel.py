@@ -0,0 +1,32 @@
+import json
+import os
+import pytest
+import benchmark
+import cluster_cands
+import reading_cands
+import synthetic_cands
+
+
+default_config_path = os.path.join(os.path.dirname(cluster_cands.__file__), 'default_config.json')
+
+
+@pytest.fixture(scope='module')
+def pointing(tmp_path_factory):
+    # Small synthetic pointing and its clusters from the reference implementation
+    with open(default_config_path) as json_data_file:
+        config = json.load(json_data_file)
+    files, _ = synthetic_cands.generate_pointing(str(tmp_path_factory.mktemp('pointing')),
+                                                 n_beams=20, n_candidates=600, seed=1)
+    df_cands, _, obs_meta_data = reading_cands.read_candidate_files(files, verbose=False)
+    df_reference = cluster_cands.cluster_cand_df_reference(df_cands.copy(), obs_meta_data, config)
+    return df_cands, obs_meta_data, config, df_reference
+
+
+@pytest.mark.parametrize('method', cluster_cands.cluster_methods)
+def test_cluster_method_matches_reference(pointing, method):
+    if method == 'numba':
+        pytest.importorskip('numba')
+    df_cands, obs_meta_data, config, df_reference = pointing
+    df_method = cluster_cands.cluster_cand_df(df_cands.copy(), obs_meta_data,
+                                              dict(config, cluster_method=method))
+    assert benchmark.identical_clusters(df_reference, df_method)